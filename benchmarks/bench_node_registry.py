@@ -0,0 +1,152 @@
+# Times storing one collection round from N simulated nodes, comparing the address
+# indexed NodeRegistry in server.py against the original linear scans of
+# config["sdrs"] and the data list. Nodes are polled from a local stub /power server.
+#
+#   python3 benchmarks/bench_node_registry.py [nodes]
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import server
+
+START_MHZ, END_MHZ, BANDWIDTH_MHZ = 100, 200, 10
+
+POWER_RESPONSE = json.dumps(
+    [
+        {"freq_mhz": f + BANDWIDTH_MHZ / 2, "power_dbm": -100.0}
+        for f in range(START_MHZ, END_MHZ, BANDWIDTH_MHZ)
+    ]
+).encode()
+
+
+class StubPowerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(POWER_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(POWER_RESPONSE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubPowerServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+async def collect_round(sdrs, settings):
+    async with server.create_collect_session() as session:
+        return await asyncio.gather(*(server.collect(session, sdr, settings) for sdr in sdrs))
+
+
+def legacy_store(config, data, sdr, result, cloudrf_noise_data):
+    found_in_config = False
+
+    for config_sdr in config["sdrs"]:
+        if config_sdr["address"] == sdr["address"]:
+            found_in_config = True
+
+    if not found_in_config:
+        return
+
+    sdr_data = []
+    for frequency, noise in zip(*(values.tolist() for values in result[:2])):
+        cloudrf_noise_data.append(
+            {
+                "frequency": frequency,
+                "latitude": sdr["latitude"],
+                "longitude": sdr["longitude"],
+                "noise": noise,
+            }
+        )
+        sdr_data.append({"frequency": frequency, "noise": noise})
+
+    for i, existing_data in enumerate(data):
+        if existing_data["address"] == sdr["address"]:
+            data[i]["data"] = sdr_data
+            return
+
+    data.append(
+        {
+            "address": sdr["address"],
+            "latitude": sdr["latitude"],
+            "longitude": sdr["longitude"],
+            "data": sdr_data,
+        }
+    )
+
+
+if __name__ == "__main__":
+    node_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    httpd = StubPowerServer(("127.0.0.1", 0), StubPowerHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    port = httpd.server_address[1]
+
+    sdrs = [
+        {"address": f"http://127.0.0.1:{port}/node{i}", "latitude": 46.3, "longitude": 6.17}
+        for i in range(node_count)
+    ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = os.path.join(directory, "config.json")
+        with open(config_path, "w") as f:
+            json.dump(
+                {
+                    "start_mhz": START_MHZ,
+                    "end_mhz": END_MHZ,
+                    "bandwidth_mhz": BANDWIDTH_MHZ,
+                    "sdrs": sdrs,
+                },
+                f,
+            )
+
+        server.config_store = server.ConfigStore(config_path)
+        server.HISTORY_QUEUE_SIZE = 4 * node_count
+        server.history = server.HistoryStore(os.path.join(directory, "history.sqlite"))
+        server.history.start()
+        with server.registry.lock:
+            server.registry.sync(server.config_store.snapshot()["sdrs"])
+
+        settings = {"start_mhz": START_MHZ, "end_mhz": END_MHZ, "bandwidth_mhz": BANDWIDTH_MHZ}
+
+        t = time.perf_counter()
+        results = asyncio.run(collect_round(server.config_store.snapshot()["sdrs"], settings))
+        poll_s = time.perf_counter() - t
+
+        errors = sum(1 for err, _, _ in results if err)
+
+        legacy_config = {"sdrs": sdrs}
+        legacy_data = []
+        t = time.perf_counter()
+        for _ in range(2):
+            for err, sdr, result in results:
+                if not err:
+                    legacy_store(legacy_config, legacy_data, sdr, result, [])
+        legacy_s = (time.perf_counter() - t) / 2
+
+        t = time.perf_counter()
+        for _ in range(2):
+            for err, sdr, result in results:
+                if not err:
+                    server.store_result(sdr, result, [])
+        registry_s = (time.perf_counter() - t) / 2
+
+    httpd.shutdown()
+
+    print(f"{node_count} nodes polled from stub in {poll_s * 1e3:.1f} ms ({errors} errors)")
+    print(f"legacy store   : {legacy_s * 1e3:9.2f} ms per round")
+    print(f"registry store : {registry_s * 1e3:9.2f} ms per round ({legacy_s / registry_s:.1f}x)")
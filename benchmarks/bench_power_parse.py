@@ -0,0 +1,103 @@
+# Compares the vectorized soapy_power parsing/binning in node.py against the
+# original per-value loop.
+#
+#   python3 benchmarks/bench_power_parse.py [recorded_soapy_power_output.csv]
+#
+# Without a recording, a 100-2000MHz sweep is synthesized in soapy_power's format.
+
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from capture_profile import PROFILE_DEFAULTS
+from node import parse_soapy_power, bin_sweep
+
+CROP_PERCENT = PROFILE_DEFAULTS["crop_percent"]
+FFT_BINS = PROFILE_DEFAULTS["fft_bins"]
+
+REPEATS = 5
+
+
+def synthesize_output(start_mhz, end_mhz, bandwidth_mhz, fft_bins=FFT_BINS):
+    rng = np.random.default_rng(0)
+    step_hz = bandwidth_mhz * 1e6 / fft_bins
+    usable_hz = bandwidth_mhz * 1e6 * (1 - CROP_PERCENT / 100)
+    kept_bins = int(fft_bins * (1 - CROP_PERCENT / 100))
+
+    lines = []
+    low_hz = start_mhz * 1e6
+    while low_hz < end_mhz * 1e6:
+        powers = rng.normal(-100, 3, kept_bins)
+        lines.append(
+            f"2025-01-01, 00:00:00, {low_hz:.0f}, {low_hz + usable_hz:.0f}, {step_hz:.2f}, 1000, "
+            + ", ".join(f"{p:.6f}" for p in powers)
+        )
+        low_hz += usable_hz
+
+    return lines
+
+
+def legacy_parse_and_bin(lines, start_mhz, end_mhz, bandwidth_mhz):
+    bins = np.arange(start_mhz, end_mhz, bandwidth_mhz)
+    bin_lin_power_totals = np.zeros_like(bins, dtype=np.float32)
+    bin_counts = np.zeros_like(bins, dtype=np.uint)
+
+    for line in lines:
+
+        parts = line.split(",")
+
+        fft_start_mhz = float(parts[2]) * 1e-6
+        fft_step_mhz = float(parts[4]) * 1e-6
+
+        for i, power in enumerate(parts[6:]):
+            freq = fft_start_mhz + (i + 0.5) * fft_step_mhz
+
+            b = np.digitize(freq, bins) - 1
+
+            if b < len(bins):
+                bin_lin_power_totals[b] += math.pow(10, float(power) / 10)
+                bin_counts[b] += 1
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return bins, 10 * np.log10(bin_lin_power_totals / bin_counts)
+
+
+def vectorized_parse_and_bin(lines, start_mhz, end_mhz, bandwidth_mhz):
+    freqs_mhz, powers_db = parse_soapy_power(lines)
+    return bin_sweep(freqs_mhz, powers_db, start_mhz, end_mhz, bandwidth_mhz)
+
+
+def best_of(fn, *args):
+    best = math.inf
+    for _ in range(REPEATS):
+        t = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - t)
+    return best, result
+
+
+if __name__ == "__main__":
+    start_mhz, end_mhz, bandwidth_mhz = 100, 2000, 10
+
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "r") as f:
+            lines = [line for line in f.read().splitlines() if line.strip()]
+        start_mhz = int(float(lines[0].split(",")[2]) * 1e-6)
+        end_mhz = int(math.ceil(float(lines[-1].split(",")[3]) * 1e-6))
+    else:
+        lines = synthesize_output(start_mhz, end_mhz, bandwidth_mhz)
+
+    fft_values = sum(line.count(",") - 5 for line in lines)
+    print(f"{len(lines)} rows, {fft_values} FFT values, {start_mhz}MHz:{end_mhz}MHz {bandwidth_mhz}MHz")
+
+    legacy_s, (_, legacy_powers) = best_of(legacy_parse_and_bin, lines, start_mhz, end_mhz, bandwidth_mhz)
+    vector_s, (_, vector_powers) = best_of(vectorized_parse_and_bin, lines, start_mhz, end_mhz, bandwidth_mhz)
+
+    print(f"legacy loop : {legacy_s * 1e3:9.2f} ms")
+    print(f"vectorized  : {vector_s * 1e3:9.2f} ms ({legacy_s / vector_s:.1f}x)")
+    print(f"max difference: {np.nanmax(np.abs(legacy_powers - vector_powers)):.6f} dB")
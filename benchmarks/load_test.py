@@ -0,0 +1,243 @@
+# End-to-end load test. Starts simulated nodes (node.py --simulate) and a headless
+# server.py on localhost, lets the server collect for a while and reports how well it
+# kept up at each scale. Run it before and after changes to collection, storage or the API.
+#
+#   python3 benchmarks/load_test.py [--nodes 10 100 1000] [--duration 60]
+#
+# Several simulated nodes share each node.py process, one port each, so 1000 nodes
+# don't need 1000 processes.
+
+import argparse
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def wait_for_port(port, timeout_s):
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        with socket.socket() as s:
+            if s.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout_s}s")
+
+
+# CPU seconds used so far and resident memory in MB of a process
+def process_usage(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status") as f:
+            rss_kb = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+    except (FileNotFoundError, StopIteration):
+        return 0, 0
+
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, rss_kb / 1024
+
+
+def start(command, cwd):
+    return subprocess.Popen(
+        command,
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        # So the simulators the nodes start can be stopped with them
+        start_new_session=True,
+    )
+
+
+def stop(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+def run(args, node_count, workdir):
+    node_ports = [args.base_port + i for i in range(node_count)]
+    server_port = args.base_port - 1
+
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        json.dump(
+            {
+                "start_mhz": args.start_mhz,
+                "end_mhz": args.end_mhz,
+                "bandwidth_mhz": args.bandwidth_mhz,
+                # Failing posts would be retried during the run
+                "cloudrf_api": None,
+                "cloudrf_api_key": "",
+                "sdrs": [
+                    {
+                        "address": f"http://127.0.0.1:{port}",
+                        "latitude": 51 + random.uniform(-1, 1),
+                        "longitude": -2 + random.uniform(-1, 1),
+                    }
+                    for port in node_ports
+                ],
+            },
+            f,
+        )
+
+    nodes = []
+    for i in range(0, node_count, args.nodes_per_process):
+        listen = " ".join(f"127.0.0.1:{port}" for port in node_ports[i : i + args.nodes_per_process])
+        nodes.append(
+            start(
+                [
+                    sys.executable,
+                    os.path.join(ROOT, "node.py"),
+                    "--simulate",
+                    "--listen",
+                    listen,
+                    "--sim-hop-s",
+                    f"{args.hop_s}",
+                ],
+                workdir,
+            )
+        )
+    server = None
+
+    try:
+        for port in node_ports:
+            wait_for_port(port, 30)
+
+        server = start(
+            [
+                sys.executable,
+                os.path.join(ROOT, "server.py"),
+                "--headless",
+                "--listen",
+                f"127.0.0.1:{server_port}",
+                "--collectors",
+                f"{args.collectors}",
+            ],
+            workdir,
+        )
+        wait_for_port(server_port, 30)
+
+        session = requests.Session()
+        started = time.monotonic()
+        last_update = {}
+        staleness = []
+        rounds = []
+        round_started = started
+        round_pending = set(f"http://127.0.0.1:{port}" for port in node_ports)
+        first_round_s = None
+        revision = None
+        usage_start = None
+
+        # Follow /data as a dashboard would and note when each node's data changes
+        while time.monotonic() - started < args.duration:
+            params = {"wait": 1}
+            if revision is not None:
+                params["since"] = revision
+            body = session.get(f"http://127.0.0.1:{server_port}/data", params=params, timeout=10).json()
+            now = time.monotonic()
+            revision = body["revision"]
+
+            for sdr in body["sdrs"]:
+                last_update[sdr["address"]] = now
+                round_pending.discard(sdr["address"])
+
+            if len(round_pending) == 0:
+                rounds.append(now - round_started)
+                if first_round_s is None:
+                    first_round_s = now - started
+                    usage_start = (now, [process_usage(p.pid)[0] for p in [server] + nodes])
+                round_started = now
+                round_pending = set(last_update)
+
+            # Only count staleness once every node has reported
+            if first_round_s is not None:
+                staleness.extend(now - t for t in last_update.values())
+
+        usage = [process_usage(p.pid) for p in [server] + nodes]
+    finally:
+        if server is not None:
+            stop(server)
+        for node in nodes:
+            stop(node)
+
+    if usage_start is None:
+        return {"nodes": node_count, "first_round_s": None}
+
+    elapsed_s = time.monotonic() - usage_start[0]
+    cpu_percent = [
+        100 * (cpu_s - cpu_start_s) / elapsed_s for (cpu_s, _), cpu_start_s in zip(usage, usage_start[1])
+    ]
+
+    return {
+        "nodes": node_count,
+        "first_round_s": first_round_s,
+        "round_p50_s": float(np.median(rounds[1:] or rounds)),
+        "round_max_s": max(rounds[1:] or rounds),
+        "stale_p50_s": float(np.percentile(staleness, 50)),
+        "stale_p95_s": float(np.percentile(staleness, 95)),
+        "stale_max_s": max(staleness),
+        "server_cpu_percent": cpu_percent[0],
+        "server_rss_mb": usage[0][1],
+        "nodes_cpu_percent": sum(cpu_percent[1:]),
+        "nodes_rss_mb": sum(rss_mb for _, rss_mb in usage[1:]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DORA end-to-end load test")
+    parser.add_argument("--nodes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run each scale for")
+    parser.add_argument("--nodes-per-process", type=int, default=100)
+    parser.add_argument("--base-port", type=int, default=9200)
+    parser.add_argument("--start-mhz", type=int, default=100)
+    parser.add_argument("--end-mhz", type=int, default=200)
+    parser.add_argument("--bandwidth-mhz", type=int, default=10)
+    parser.add_argument("--hop-s", type=float, default=0.05, help="simulated time per retune")
+    parser.add_argument("--collectors", type=int, default=0, help="server collector processes")
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = parser.parse_args()
+
+    columns = [
+        ("nodes", "nodes", "{:>6}"),
+        ("first_round_s", "first round s", "{:>14.2f}"),
+        ("round_p50_s", "round p50 s", "{:>12.2f}"),
+        ("round_max_s", "round max s", "{:>12.2f}"),
+        ("stale_p50_s", "stale p50 s", "{:>12.2f}"),
+        ("stale_p95_s", "stale p95 s", "{:>12.2f}"),
+        ("stale_max_s", "stale max s", "{:>12.2f}"),
+        ("server_cpu_percent", "server cpu %", "{:>13.1f}"),
+        ("server_rss_mb", "server MB", "{:>10.1f}"),
+        ("nodes_cpu_percent", "nodes cpu %", "{:>12.1f}"),
+        ("nodes_rss_mb", "nodes MB", "{:>9.1f}"),
+    ]
+
+    if not args.json:
+        print(" ".join(f"{title:>{len(fmt.format(0))}}" for _, title, fmt in columns))
+
+    for node_count in args.nodes:
+        with tempfile.TemporaryDirectory() as workdir:
+            result = run(args, node_count, workdir)
+
+        if args.json:
+            print(json.dumps(result))
+        elif result["first_round_s"] is None:
+            print(f"{node_count:>6} never collected from every node within {args.duration:.0f}s")
+        else:
+            print(" ".join(fmt.format(result[key]) for key, _, fmt in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import math
+
+# Capture profiles trade sweep time against resolution. Both node.py and server.py use this
+# so they agree on what a profile is and how long it takes to sweep.
+
+# Used for anything a profile leaves out, what nodes have always swept with
+PROFILE_DEFAULTS = {
+    "fft_bins": 32,
+    "crop_percent": 30,
+    "integration_s": None,
+    "window": "bartlett",
+    "gain": 30,
+}
+
+FFT_WINDOWS = ("boxcar", "hann", "hamming", "blackman", "bartlett", "kaiser", "tukey")
+
+# soapy_power averages this many FFTs per hop when not given an integration time
+SOAPY_POWER_DEFAULT_REPEATS = 1600
+# Rough time to retune and settle an SDR between hops
+PLAN_RETUNE_S = 0.03
+
+
+# Returns profile with defaults filled in, or raises ValueError
+def validate_profile(profile):
+    if profile is None:
+        profile = {}
+    if type(profile) != dict:
+        raise ValueError("profile must be an object")
+
+    unknown = set(profile) - set(PROFILE_DEFAULTS)
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown profile settings: {', '.join(sorted(unknown))}")
+
+    profile = {**PROFILE_DEFAULTS, **profile}
+
+    if type(profile["fft_bins"]) != int or profile["fft_bins"] < 4 or profile["fft_bins"] > 65536:
+        raise ValueError("fft_bins must be between 4 and 65536")
+    if type(profile["crop_percent"]) not in (int, float) or profile["crop_percent"] < 0 or profile["crop_percent"] > 90:
+        raise ValueError("crop_percent must be between 0 and 90")
+    if profile["integration_s"] is not None and (
+        type(profile["integration_s"]) not in (int, float) or profile["integration_s"] <= 0 or profile["integration_s"] > 60
+    ):
+        raise ValueError("integration_s must be between 0 and 60 seconds")
+    if profile["window"] not in FFT_WINDOWS:
+        raise ValueError(f"window must be one of {', '.join(FFT_WINDOWS)}")
+    if type(profile["gain"]) not in (int, float) or profile["gain"] < 0 or profile["gain"] > 100:
+        raise ValueError("gain must be between 0 and 100 dB")
+
+    return profile
+
+
+# How each bin's value is worked out from the FFT values in it. "mean" averages them in the
+# linear domain. "noise_floor" takes a low percentile instead, so carriers in the bin don't
+# raise it, and also reports the fraction of FFT values more than occupancy_threshold_db above it.
+MEASUREMENT_DEFAULTS = {
+    "mode": "mean",
+    "percentile": 10,
+    "occupancy_threshold_db": 10,
+}
+
+MEASUREMENT_MODES = ("mean", "noise_floor")
+
+
+# Returns measurement with defaults filled in, or raises ValueError
+def validate_measurement(measurement):
+    if measurement is None:
+        measurement = {}
+    if type(measurement) != dict:
+        raise ValueError("measurement must be an object")
+
+    unknown = set(measurement) - set(MEASUREMENT_DEFAULTS)
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown measurement settings: {', '.join(sorted(unknown))}")
+
+    measurement = {**MEASUREMENT_DEFAULTS, **measurement}
+
+    if measurement["mode"] not in MEASUREMENT_MODES:
+        raise ValueError(f"mode must be one of {', '.join(MEASUREMENT_MODES)}")
+    if type(measurement["percentile"]) not in (int, float) or measurement["percentile"] < 0 or measurement["percentile"] > 100:
+        raise ValueError("percentile must be between 0 and 100")
+    if type(measurement["occupancy_threshold_db"]) not in (int, float) or measurement["occupancy_threshold_db"] < 0:
+        raise ValueError("occupancy_threshold_db must be 0 or more")
+
+    return measurement
+
+
+def soapy_power_args(profile):
+    args = [
+        "-k",
+        f"{profile['crop_percent']}",
+        "-g",
+        f"{profile['gain']}",
+        "-b",
+        f"{profile['fft_bins']}",
+        "--fft-window",
+        profile["window"],
+    ]
+
+    if profile["integration_s"] is not None:
+        args += ["-t", f"{profile['integration_s']}"]
+
+    return args
+
+
+# Estimates how soapy_power will sweep start_mhz:end_mhz. Each hop is sampled at
+# bandwidth_mhz and crop_percent of it is thrown away, so cropping less means fewer retunes.
+def plan_sweep(start_mhz, end_mhz, bandwidth_mhz, profile):
+    hop_mhz = bandwidth_mhz * (1 - profile["crop_percent"] / 100)
+    retunes = max(math.ceil((end_mhz - start_mhz) / hop_mhz), 1)
+
+    if profile["integration_s"] is not None:
+        integration_s = profile["integration_s"]
+    else:
+        integration_s = SOAPY_POWER_DEFAULT_REPEATS * profile["fft_bins"] / (bandwidth_mhz * 1e6)
+
+    hop_s = integration_s + PLAN_RETUNE_S
+
+    return {
+        "retunes": retunes,
+        "hop_mhz": hop_mhz,
+        "hop_s": hop_s,
+        "sweep_s": retunes * hop_s,
+    }
+
+
+# Returns profile, or the closest profile that sweeps within max_sweep_s, or None if there
+# isn't one. Integration time is given up first, then cropping, then FFT size.
+def fit_profile(start_mhz, end_mhz, bandwidth_mhz, profile, max_sweep_s):
+    plan = plan_sweep(start_mhz, end_mhz, bandwidth_mhz, profile)
+    if plan["sweep_s"] <= max_sweep_s:
+        return profile
+
+    if profile["integration_s"] is not None:
+        integration_s = max_sweep_s / plan["retunes"] - PLAN_RETUNE_S
+        fitted = {**profile, "integration_s": math.floor(integration_s * 1000) / 1000}
+
+        if fitted["integration_s"] > 0 and plan_sweep(start_mhz, end_mhz, bandwidth_mhz, fitted)["sweep_s"] <= max_sweep_s:
+            return fitted
+
+        profile = {**profile, "integration_s": None}
+
+    # Without an integration time soapy_power averages a fixed number of FFTs, so smaller FFTs are quicker
+    fft_bins = profile["fft_bins"]
+    while fft_bins >= 4:
+        for crop_percent in range(math.floor(profile["crop_percent"]), -1, -1):
+            fitted = {**profile, "fft_bins": fft_bins, "crop_percent": crop_percent}
+
+            if plan_sweep(start_mhz, end_mhz, bandwidth_mhz, fitted)["sweep_s"] <= max_sweep_s:
+                return fitted
+
+        fft_bins //= 2
+
+    return None
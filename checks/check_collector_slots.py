@@ -0,0 +1,109 @@
+# Checks that CollectorPool gets every shared memory slot back: after polls that are answered and
+# stored, and after polls that are cancelled (as a retask does) but answered by the node later.
+# Nodes are a local stub /power server that answers after a delay.
+#
+#   python3 checks/check_collector_slots.py
+
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import server
+
+START_MHZ, END_MHZ, BANDWIDTH_MHZ = 100, 200, 10
+
+# Long enough to cancel a poll before the stub answers it
+ANSWER_DELAY_S = 1
+
+POWER_RESPONSE = json.dumps(
+    [
+        {"freq_mhz": f + BANDWIDTH_MHZ / 2, "power_dbm": -100.0}
+        for f in range(START_MHZ, END_MHZ, BANDWIDTH_MHZ)
+    ]
+).encode()
+
+
+class DelayedPowerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(ANSWER_DELAY_S)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(POWER_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(POWER_RESPONSE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubPowerServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def check(ok, message):
+    print(f"{'ok  ' if ok else 'FAIL'} {message}")
+    return ok
+
+
+async def run(collectors, port, polls):
+    settings = {"start_mhz": START_MHZ, "end_mhz": END_MHZ, "bandwidth_mhz": BANDWIDTH_MHZ}
+    sdrs = [{"address": f"http://127.0.0.1:{port}/node{i}"} for i in range(polls)]
+    worker = collectors.workers[0]
+    passed = True
+
+    # Answered polls hold their slot until the lease is given back
+    results = await asyncio.gather(
+        *(collectors.collect(sdr, settings, server.REQUEST_TIMEOUT_S, None, False) for sdr in sdrs)
+    )
+    errors = [result for err, _, result, _ in results if err]
+    passed &= check(len(errors) == 0, f"{polls - len(errors)} of {polls} polls answered")
+    passed &= check(
+        len(worker["free_slots"]) == server.COLLECT_MAX_CONCURRENT - polls, f"{polls} slots held by leases"
+    )
+    for _, _, _, lease in results:
+        collectors.release(lease)
+    passed &= check(len(worker["free_slots"]) == server.COLLECT_MAX_CONCURRENT, "every slot back after release")
+
+    # Cancelled polls get their slots back once the node answers them
+    tasks = [
+        asyncio.create_task(collectors.collect(sdr, settings, server.REQUEST_TIMEOUT_S, None, False)) for sdr in sdrs
+    ]
+    await asyncio.sleep(ANSWER_DELAY_S / 2)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    deadline = time.monotonic() + ANSWER_DELAY_S + server.REQUEST_TIMEOUT_S
+    while len(worker["free_slots"]) < server.COLLECT_MAX_CONCURRENT and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    passed &= check(
+        len(worker["free_slots"]) == server.COLLECT_MAX_CONCURRENT,
+        f"{len(worker['free_slots'])} of {server.COLLECT_MAX_CONCURRENT} slots free after {polls} cancelled polls",
+    )
+    passed &= check(len(collectors.pending) == 0, f"{len(collectors.pending)} requests still pending")
+
+    return passed
+
+
+if __name__ == "__main__":
+    httpd = StubPowerServer(("127.0.0.1", 0), DelayedPowerHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    collectors = server.CollectorPool(1)
+    collectors.start()
+    try:
+        passed = asyncio.run(run(collectors, httpd.server_address[1], 10))
+    finally:
+        collectors.close()
+        httpd.shutdown()
+
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,195 @@
+# Checks the CloudRF uploader end to end against a stub API. Starts a simulated node
+# (node.py --simulate) and a headless server.py that posts to the stub, then checks that
+#
+#   - batches the API can't take are journaled when the server is stopped with SIGTERM
+#   - the journal is replayed once the API takes batches again
+#   - batches the API refuses with a 4xx aren't retried and are set aside
+#   - an API that refuses gzip with a 400 gets batches uncompressed instead of them being set aside
+#
+#   python3 checks/check_uploader.py
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+
+from load_test import ROOT, start, stop, wait_for_port
+
+
+# Answers every POST with the status and body in stub.reply, or with a 400 to compressed ones if
+# stub.refuse_gzip is set, and keeps what was posted
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        compressed = self.headers.get("Content-Encoding") == "gzip"
+        if compressed:
+            body = gzip.decompress(body)
+
+        status, reply = self.server.reply
+        if compressed and self.server.refuse_gzip:
+            status, reply = 400, {"error": "unsupported content encoding"}
+        with self.server.lock:
+            self.server.posts.append((status, json.loads(body)))
+
+        reply = json.dumps(reply).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", f"{len(reply)}")
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(port):
+    stub = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+    stub.lock = threading.Lock()
+    stub.posts = []
+    stub.reply = (200, {})
+    stub.refuse_gzip = False
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    return stub
+
+
+def wait_for(condition, timeout_s, what):
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        if condition():
+            return
+        time.sleep(0.1)
+    raise RuntimeError(f"Timed out after {timeout_s}s waiting for {what}")
+
+
+def read_lines(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+def check(ok, message):
+    print(f"{'ok  ' if ok else 'FAIL'} {message}")
+    return ok
+
+
+def run(args, workdir):
+    node_port = args.base_port
+    server_port = args.base_port + 1
+    stub = start_stub(args.base_port + 2)
+    journal_path = os.path.join(workdir, "cloudrf_journal.jsonl")
+    rejected_path = os.path.join(workdir, "cloudrf_rejected.jsonl")
+
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        json.dump(
+            {
+                "start_mhz": 100,
+                "end_mhz": 200,
+                "bandwidth_mhz": 10,
+                "cloudrf_api": f"http://127.0.0.1:{args.base_port + 2}",
+                "cloudrf_api_key": "stub",
+                "sdrs": [{"address": f"http://127.0.0.1:{node_port}", "latitude": 51, "longitude": -2}],
+            },
+            f,
+        )
+
+    server_command = [
+        sys.executable,
+        os.path.join(ROOT, "server.py"),
+        "--headless",
+        "--listen",
+        f"127.0.0.1:{server_port}",
+    ]
+
+    node = start([sys.executable, os.path.join(ROOT, "node.py"), "--simulate", "--listen", f"127.0.0.1:{node_port}"], workdir)
+    server = None
+    passed = True
+
+    try:
+        wait_for_port(node_port, 30)
+
+        # The API is down, whatever is being retried has to be journaled on SIGTERM
+        stub.reply = (503, {"error": "unavailable"})
+        server = start(server_command, workdir)
+        wait_for(lambda: len(stub.posts) > 0, args.timeout, "the first post")
+        stop(server)
+        server = None
+
+        journaled = read_lines(journal_path)
+        passed &= check(len(journaled) > 0, f"{len(journaled)} batches journaled on SIGTERM while the API was down")
+
+        # The API is back, the journal is replayed after the first batch that gets through
+        stub.posts = []
+        stub.reply = (200, {})
+        server = start(server_command, workdir)
+        wait_for(lambda: not os.path.exists(journal_path), args.timeout, "the journal to be replayed")
+        replayed = [batch for status, batch in stub.posts if json.dumps(batch) in journaled]
+        passed &= check(len(replayed) == len(journaled), f"{len(replayed)} of {len(journaled)} journaled batches replayed")
+        stop(server)
+        server = None
+
+        # The API refuses batches, each is posted once and set aside
+        stub.posts = []
+        stub.reply = (400, {"error": "refused"})
+        server = start(server_command, workdir)
+        wait_for(lambda: len(stub.posts) > 0, args.timeout, "a refused post")
+        # Long enough for a retry if there was going to be one
+        time.sleep(3)
+        stop(server)
+        server = None
+
+        # Refused batches are tried once more uncompressed in case it was the gzip being refused
+        posted = [json.dumps(batch) for status, batch in stub.posts]
+        rejected = read_lines(rejected_path)
+        passed &= check(
+            all(posted.count(batch) <= 2 for batch in posted), f"{len(set(posted))} refused batches not retried"
+        )
+        passed &= check(set(posted) <= set(rejected), f"{len(rejected)} refused batches set aside")
+        passed &= check(
+            len(set(posted) & set(read_lines(journal_path))) == 0, "refused batches not journaled"
+        )
+
+        # The API takes batches but not compressed, they are sent uncompressed rather than set aside
+        os.remove(rejected_path)
+        stub.posts = []
+        stub.reply = (200, {})
+        stub.refuse_gzip = True
+        server = start(server_command, workdir)
+        wait_for(lambda: sum(1 for status, _ in stub.posts if status == 200) >= 2, args.timeout, "two accepted posts")
+        stop(server)
+        server = None
+
+        refused = [batch for status, batch in stub.posts if status == 400]
+        passed &= check(len(refused) == 1, f"{len(refused)} batches sent compressed before switching to uncompressed")
+        passed &= check(len(read_lines(rejected_path)) == 0, "no batches set aside when only gzip is refused")
+
+    finally:
+        if server is not None:
+            stop(server)
+        stop(node)
+        stub.shutdown()
+
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the CloudRF uploader against a stub API")
+    parser.add_argument("--base-port", type=int, default=9100)
+    parser.add_argument("--timeout", type=float, default=60, help="longest wait for each step")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        passed = run(args, workdir)
+
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Minimal Prometheus style metrics shared by node.py and server.py, served as text from
+# /metrics. Updates take a lock and a dict lookup, and do nothing at all when disabled.
+
+# Set to False (--no-metrics) to turn every update and timer into a no-op
+enabled = True
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from a quick lock up to a slow sweep
+DEFAULT_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+registered = []
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+        registered.append(self)
+
+    def _key(self, labels):
+        return tuple(f"{labels[label]}" for label in self.labels)
+
+    def _label_text(self, key, extra=""):
+        pairs = [f'{label}="{escape(value)}"' for label, value in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if len(pairs) > 0 else ""
+
+    def remove(self, /, **labels):
+        with self.lock:
+            self.values.pop(self._key(labels), None)
+
+    def samples(self):
+        with self.lock:
+            return list(self.values.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self.samples():
+            lines.append(f"{self.name}{self._label_text(key)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, /, **labels):
+        if not enabled:
+            return
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+# Either set directly, or given a function returning {label values tuple: value} that is
+# called on every scrape
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def set(self, value, /, **labels):
+        if not enabled:
+            return
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        if self.collect is not None:
+            return list(self.collect().items())
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, /, **labels):
+        if not enabled:
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, counts in self.samples():
+            counts = list(counts)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = self._label_text(key, f'le="{format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_text(key)} {format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{self._label_text(key)} {cumulative}")
+        return lines
+
+
+class Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+no_timer = nullcontext()
+
+
+# with timed(histogram, label=value): records how long the body took
+def timed(histogram, /, **labels):
+    if not enabled:
+        return no_timer
+    return Timer(histogram, labels)
+
+
+# Holds lock for the body, recording how long it took to get it
+@contextmanager
+def timed_lock(lock, histogram, /, **labels):
+    with timed(histogram, **labels):
+        lock.acquire()
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and math.isnan(value):
+        return "NaN"
+    return f"{value}"
+
+
+def render():
+    lines = []
+    for metric in registered:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
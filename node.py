@@ -1,18 +1,98 @@
+import argparse
+import itertools
 import math
+import os
+import struct
 import subprocess
+import sys
 import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future
 
 from flask import Flask, request, make_response
 import numpy as np
 from waitress import serve
 
-soapy_power_lock = threading.Lock()
+import metrics
+from capture_profile import plan_sweep, soapy_power_args, validate_measurement, validate_profile
+
 app = Flask(__name__)
 
-CROP_PERCENT = 30
-GAIN = 30
-FFT_BINS = 32
+# How long to wait for soapy_power on top of the time the capture profile should take
 SOAPY_POWER_TIMEOUT = 8
+SOAPY_DETECT_TIMEOUT = 20
+
+# Enough rows for a full 1-2000MHz sweep at 1MHz bandwidth after cropping
+SWEEP_RING_ROWS = 4096
+# Close the SDR if nobody has asked for data in this long
+CAPTURE_IDLE_TIMEOUT_S = 300
+# Statistics are kept for this many recent taskings of each SDR, so requests that take turns
+# on it each keep theirs
+CAPTURE_STATS_TASKINGS = 4
+
+# Requests for a tasking swept more recently than this are answered from the cache
+SWEEP_CACHE_MAX_AGE_S = 2
+SWEEP_CACHE_MAX_ENTRIES = 16
+
+# Sweeps recently sent to clients, kept so a client sending one back in If-None-Match can be
+# told nothing has changed beyond its deadband_db since
+SENT_SWEEPS_MAX_ENTRIES = 256
+
+# Compact alternative to the JSON response, sent when the Accept header asks for it:
+# magic, first bin centre MHz, bin step MHz, bin count, then the bins as little-endian
+# float32 dBm with NaN for bins that have no data
+POWER_MIME_TYPE = "application/x-dora-power"
+POWER_MAGIC = b"DOR1"
+POWER_HEADER = struct.Struct("<4sddI")
+# Sent instead when the sweep has occupancy (noise_floor mode): the same header and bins,
+# then each bin's occupancy as float32
+POWER_OCCUPANCY_MAGIC = b"DOR3"
+
+# Sent instead when statistics are asked for: the same header plus a plane count, then
+# each of POWER_STATS_PLANES as a block of float32 bins, followed by an occupancy plane
+# when the sweep has occupancy
+POWER_STATS_MAGIC = b"DOR2"
+POWER_STATS_HEADER = struct.Struct("<4sddII")
+POWER_STATS_PLANES = (
+    "power_dbm", "mean_dbm", "stddev_db", "min_dbm", "max_dbm", "p10_dbm", "p50_dbm", "p90_dbm", "sweeps",
+)
+
+# Every sweep is added to running per-bin statistics, kept in buckets of STATS_BUCKET_S so
+# /power can report over a window of up to STATS_BUCKET_S * STATS_BUCKETS seconds
+STATS_BUCKET_S = 20
+STATS_BUCKETS = 30
+# Percentiles come from a histogram of each bin's power in STATS_HIST_STEP_DB steps over this range
+STATS_HIST_MIN_DB = -160
+STATS_HIST_MAX_DB = 0
+STATS_HIST_STEP_DB = 2
+STATS_HIST_STEPS = (STATS_HIST_MAX_DB - STATS_HIST_MIN_DB) // STATS_HIST_STEP_DB
+# Each bin costs about 200 bytes per bucket, 160 of them for the histogram, so a 1-2000MHz tasking
+# in 1MHz bins swept for the whole window takes about 12MB. Buckets are only allocated once a
+# sweep lands in them and are dropped once they are too old for any window.
+
+sweep_seconds = metrics.Histogram(
+    "dora_node_sweep_seconds", "Time soapy_power took to sweep the tasking", ("device",)
+)
+lock_wait_seconds = metrics.Histogram(
+    "dora_node_lock_wait_seconds", "Time spent waiting for capture and cache locks", ("lock",)
+)
+parse_seconds = metrics.Histogram("dora_node_parse_seconds", "Time to parse and bin a sweep")
+response_bytes = metrics.Histogram(
+    "dora_node_response_bytes",
+    "Size of /power responses",
+    ("format",),
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576),
+)
+power_requests = metrics.Counter("dora_node_power_requests_total", "/power requests", ("status",))
+
+# Command used to run soapy_power, replaced by sdr_simulator.py with --simulate
+soapy_power_program = ["soapy_power"]
+
+# Device used by requests that don't pick one: None for soapy_power's default device,
+# or "all" to split every request across all detected devices. Set with --split.
+default_devices = None
 
 
 def api_response(data, status_code=200):
@@ -21,13 +101,779 @@ def api_response(data, status_code=200):
     response.headers["Content-Type"] = "application/json"  # Set MIME type
     response.headers["Access-Control-Allow-Origin"] = "*"  # Allow all origins
     response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
-    response.headers["Access-Control-Allow-Headers"] = "Content-Type"
+    response.headers["Access-Control-Allow-Headers"] = "Content-Type, If-None-Match"
     response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
     response.headers["Pragma"] = "no-cache"
     response.headers["Expires"] = "0"  # Immediate expiration
     return response
 
 
+def parse_soapy_power(lines):
+    # Each soapy_power row is "date, time, Hz low, Hz high, Hz step, samples, dB, dB, ..."
+    # Strip the date and time then parse every remaining value of every row in one go
+    rows = [line.split(",", 2)[2] for line in lines if line.strip()]
+    row_lengths = np.fromiter((row.count(",") + 1 for row in rows), dtype=np.intp, count=len(rows))
+    values = np.fromstring(",".join(rows), sep=",")
+
+    if len(values) != row_lengths.sum():
+        raise RuntimeError("Malformed data from soapy power")
+
+    row_offsets = np.cumsum(row_lengths) - row_lengths
+    fft_counts = row_lengths - 4
+
+    fft_start_mhz = values[row_offsets] * 1e-6
+    fft_step_mhz = values[row_offsets + 2] * 1e-6
+
+    # Index of every FFT value within its own row, and the position of the dB values within values
+    row_index = np.repeat(np.arange(len(rows)), fft_counts)
+    fft_index = np.arange(fft_counts.sum()) - np.repeat(np.cumsum(fft_counts) - fft_counts, fft_counts)
+    power_index = np.repeat(row_offsets + 4, fft_counts) + fft_index
+
+    freqs_mhz = fft_start_mhz[row_index] + (fft_index + 0.5) * fft_step_mhz[row_index]
+    powers_db = values[power_index]
+
+    return freqs_mhz, powers_db
+
+
+def bin_sweep(freqs_mhz, powers_db, start_mhz, end_mhz, bandwidth_mhz):
+    bins = np.arange(start_mhz, end_mhz, bandwidth_mhz)
+
+    b = np.digitize(freqs_mhz, bins) - 1
+    in_range = b >= 0
+
+    # Average in the linear power domain
+    bin_lin_power_totals = np.bincount(
+        b[in_range], weights=np.power(10.0, powers_db[in_range] / 10), minlength=len(bins)
+    )
+    bin_counts = np.bincount(b[in_range], minlength=len(bins))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bin_powers = 10 * np.log10(bin_lin_power_totals / bin_counts)
+
+    return bins, bin_powers
+
+
+# Running statistics of each bin of a tasking over consecutive sweeps, in buckets of
+# STATS_BUCKET_S of sweeps. The mean is tracked with Welford's method in the linear power domain,
+# the standard deviation the same way in dB so it reads as a spread in dB, and percentiles with
+# a histogram per bin.
+class SweepStats:
+    def __init__(self, tasking):
+        self.lock = threading.Lock()
+        self.tasking = tasking
+        start_mhz, end_mhz, bandwidth_mhz, _ = tasking
+
+        self.bin_count = int(
+            np.count_nonzero(np.arange(start_mhz, end_mhz, bandwidth_mhz) + bandwidth_mhz / 2 < end_mhz)
+        )
+        # Arrays of each bucket that has sweeps, by bucket number
+        self.buckets = {}
+
+    def _new_bucket(self):
+        return {
+            "count": np.zeros(self.bin_count, dtype=np.int32),
+            "mean": np.zeros(self.bin_count),
+            "m2": np.zeros(self.bin_count),
+            "mean_db": np.zeros(self.bin_count),
+            "m2_db": np.zeros(self.bin_count),
+            "min": np.full(self.bin_count, np.inf, dtype=np.float32),
+            "max": np.full(self.bin_count, -np.inf, dtype=np.float32),
+            "hist": np.zeros((self.bin_count, STATS_HIST_STEPS), dtype=np.uint16),
+        }
+
+    # Drops buckets too old for any window ending at or after now
+    def expire(self, now):
+        with self.lock:
+            self._expire(int(now // STATS_BUCKET_S))
+
+    def _expire(self, newest):
+        for bucket in [bucket for bucket in self.buckets if bucket <= newest - STATS_BUCKETS]:
+            del self.buckets[bucket]
+
+    def add(self, timestamp, bin_powers):
+        bucket = int(timestamp // STATS_BUCKET_S)
+        valid = np.flatnonzero(~np.isnan(bin_powers))
+        powers_db = bin_powers[valid]
+        powers = np.power(10.0, powers_db / 10)
+
+        with self.lock:
+            self._expire(bucket)
+            stats = self.buckets.get(bucket)
+            if stats is None:
+                stats = self.buckets[bucket] = self._new_bucket()
+
+            count = stats["count"][valid] + 1
+            delta = powers - stats["mean"][valid]
+            mean = stats["mean"][valid] + delta / count
+
+            stats["count"][valid] = count
+            stats["mean"][valid] = mean
+            stats["m2"][valid] += delta * (powers - mean)
+
+            delta_db = powers_db - stats["mean_db"][valid]
+            mean_db = stats["mean_db"][valid] + delta_db / count
+            stats["mean_db"][valid] = mean_db
+            stats["m2_db"][valid] += delta_db * (powers_db - mean_db)
+            stats["min"][valid] = np.minimum(stats["min"][valid], powers_db)
+            stats["max"][valid] = np.maximum(stats["max"][valid], powers_db)
+
+            hist_index = np.clip(
+                np.floor((powers_db - STATS_HIST_MIN_DB) / STATS_HIST_STEP_DB).astype(np.intp), 0, STATS_HIST_STEPS - 1
+            )
+            stats["hist"][valid, hist_index] += 1
+
+    # Returns a dict of per-bin arrays named as in POWER_STATS_PLANES, combining every bucket
+    # that overlaps the last window_s seconds
+    def window(self, window_s, now):
+        newest = int(now // STATS_BUCKET_S)
+        oldest = int((now - window_s) // STATS_BUCKET_S)
+
+        with self.lock:
+            self._expire(newest)
+            selected = [stats for bucket, stats in self.buckets.items() if oldest <= bucket <= newest]
+
+            # (buckets, bins) of each statistic
+            def stacked(name):
+                return np.array([stats[name] for stats in selected], dtype=np.float64).reshape(-1, self.bin_count)
+
+            count = stacked("count")
+            mean = stacked("mean")
+            m2 = stacked("m2")
+            mean_db = stacked("mean_db")
+            m2_db = stacked("m2_db")
+            minimum = stacked("min").min(axis=0, initial=np.inf)
+            maximum = stacked("max").max(axis=0, initial=-np.inf)
+            hist = np.zeros((self.bin_count, STATS_HIST_STEPS), dtype=np.int64)
+            for stats in selected:
+                hist += stats["hist"]
+
+        # Chan's method for combining the buckets' means and variances
+        total = count.sum(axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            total_mean = (count * mean).sum(axis=0) / total
+            total_mean_db = (count * mean_db).sum(axis=0) / total
+            total_m2_db = (m2_db + count * (mean_db - total_mean_db) ** 2).sum(axis=0)
+
+            stats = {
+                "mean_dbm": 10 * np.log10(total_mean),
+                "stddev_db": np.sqrt(total_m2_db / (total - 1)),
+                "min_dbm": np.where(total > 0, minimum, np.nan),
+                "max_dbm": np.where(total > 0, maximum, np.nan),
+                "sweeps": total.astype(np.float64),
+            }
+
+        # The centre of the first histogram step holding at least p percent of the sweeps
+        cumulative = hist.cumsum(axis=1)
+        for p in (10, 50, 90):
+            step = (cumulative < (total * p / 100)[:, None]).sum(axis=1)
+            stats[f"p{p}_dbm"] = np.where(total > 0, STATS_HIST_MIN_DB + (step + 0.5) * STATS_HIST_STEP_DB, np.nan)
+
+        return stats
+
+
+# Robust noise floor of each bin: the FFT value at percentile within the bin, which a few
+# strong carriers can't pull up the way they do the mean. Also returns the fraction of each
+# bin's FFT values more than threshold_db above its floor.
+def noise_floor_sweep(freqs_mhz, powers_db, start_mhz, end_mhz, bandwidth_mhz, percentile, threshold_db):
+    bins = np.arange(start_mhz, end_mhz, bandwidth_mhz)
+
+    b = np.digitize(freqs_mhz, bins) - 1
+    in_range = (b >= 0) & ~np.isnan(powers_db)
+    b = b[in_range]
+    powers_db = powers_db[in_range]
+
+    # Sort by bin then power so each bin's values are a sorted run. A single float key
+    # sorts much faster than np.lexsort.
+    if len(powers_db) > 0:
+        spread_db = powers_db.max() - powers_db.min() + 1
+        order = np.argsort(b * spread_db + (powers_db - powers_db.min()))
+        b = b[order]
+        powers_db = powers_db[order]
+
+    bin_counts = np.bincount(b, minlength=len(bins))
+    bin_starts = np.cumsum(bin_counts) - bin_counts
+    has_data = bin_counts > 0
+
+    floor = np.full(len(bins), np.nan)
+    rank = np.floor((bin_counts - 1) * percentile / 100).astype(np.intp)
+    floor[has_data] = powers_db[(bin_starts + rank)[has_data]]
+
+    occupied = powers_db > floor[b] + threshold_db
+    with np.errstate(divide="ignore", invalid="ignore"):
+        occupancy = np.bincount(b, weights=occupied, minlength=len(bins)) / bin_counts
+
+    return bins, floor, occupancy
+
+
+# profile is a tuple of (setting, value) pairs so taskings can be compared and hashed
+def soapy_power_command(start_mhz, end_mhz, bandwidth_mhz, profile, device=None):
+    command = soapy_power_program + [
+        "-f",
+        f"{start_mhz}M:{end_mhz}M",
+        "-r",
+        f"{bandwidth_mhz}M",
+        "-D",
+        "constant",
+    ] + soapy_power_args(dict(profile))
+
+    if device is not None:
+        command += ["-d", device]
+
+    return command
+
+
+detected_devices = None
+detected_devices_lock = threading.Lock()
+
+
+# Returns the SoapySDR device strings (e.g. "driver=sdrplay,serial=1234") of every attached SDR
+def detect_devices(refresh=False):
+    global detected_devices
+
+    with detected_devices_lock:
+        if detected_devices is None or refresh:
+            result = subprocess.run(
+                soapy_power_program + ["--detect"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                timeout=SOAPY_DETECT_TIMEOUT,
+            )
+
+            detected_devices = [
+                line.strip().replace(", ", ",")
+                for line in result.stdout.splitlines()
+                if "driver=" in line
+            ]
+
+        return list(detected_devices)
+
+
+# Keeps a soapy_power running on one device in continuous mode so the SDR stays open
+# between requests. Rows are streamed into a ring buffer and each completed sweep
+# replaces the last one, so /power can answer straight away.
+class CaptureWorker:
+    def __init__(self, device=None):
+        self.device = device
+        self.condition = threading.Condition()
+        self.tasking = None
+        self.process = None
+        self.rows = deque(maxlen=SWEEP_RING_ROWS)
+        self.sweep = None
+        self.sweep_started = None
+        self.stats = None
+        # SweepStats of the latest CAPTURE_STATS_TASKINGS taskings, oldest first
+        self.recent_stats = OrderedDict()
+        self.error = None
+        self.last_request = 0
+        # Taskings of the requests waiting for a sweep, keyed by a ticket in the order they came
+        self.waiting = {}
+        self.tickets = itertools.count()
+        # Tickets of requests whose tasking was pre-empted
+        self.cancelled = set()
+
+    # Returns (timestamp, duration, rows) of the latest completed sweep captured after newer_than.
+    # Requests for different taskings take turns, so timeout only starts once it is this one's.
+    def latest_sweep(self, tasking, timeout, newer_than=0):
+        with metrics.timed_lock(self.condition, lock_wait_seconds, lock="capture"):
+            self.last_request = time.monotonic()
+            ticket = next(self.tickets)
+            self.waiting[ticket] = tasking
+            restarted = False
+            deadline = None
+
+            try:
+                while True:
+                    if ticket in self.cancelled:
+                        raise RuntimeError("Tasking changed during capture")
+
+                    # Start it when it's its turn, or start it again once if it has stopped
+                    if self._next_tasking(tasking) == tasking and (
+                        self.tasking != tasking or (self.process is None and not restarted)
+                    ):
+                        restarted = True
+                        self._start(tasking)
+
+                    if self.tasking == tasking:
+                        if self.sweep is not None and self.sweep[0] > newer_than:
+                            return self.sweep
+                        if self.error is not None:
+                            raise RuntimeError(self.error)
+                        if deadline is None:
+                            deadline = time.monotonic() + timeout
+
+                    remaining = deadline - time.monotonic() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        raise RuntimeError("Timed out waiting for soapy power")
+
+                    self.condition.wait(remaining)
+
+            finally:
+                self.waiting.pop(ticket, None)
+                self.cancelled.discard(ticket)
+                # Whoever is next may be able to start now
+                self.condition.notify_all()
+
+    # Start sweeping tasking if it is its turn and we aren't already, without waiting for any
+    # data. preempt starts it straight away, failing the requests waiting for any other tasking.
+    def retask(self, tasking, preempt=False):
+        with metrics.timed_lock(self.condition, lock_wait_seconds, lock="capture"):
+            self.last_request = time.monotonic()
+
+            if preempt:
+                for ticket, other in list(self.waiting.items()):
+                    if other != tasking:
+                        del self.waiting[ticket]
+                        self.cancelled.add(ticket)
+                self.condition.notify_all()
+
+            if (self.tasking != tasking or self.process is None) and self._next_tasking(tasking) == tasking:
+                self._start(tasking)
+
+    # Must be called with self.condition held. Taskings are swept in the order they were asked
+    # for, so the one being swept carries on until everyone who asked for it before anything
+    # else was asked for has had a sweep. Returns default when nobody is waiting.
+    def _next_tasking(self, default):
+        return next(iter(self.waiting.values()), default)
+
+    # Must be called with self.condition held
+    def _start(self, tasking):
+        self._stop()
+
+        self.tasking = tasking
+        self.rows.clear()
+        self.sweep = None
+        self.error = None
+
+        self.stats = self.recent_stats.pop(tasking, None)
+        if self.stats is None:
+            self.stats = SweepStats(tasking)
+        self.recent_stats[tasking] = self.stats
+        while len(self.recent_stats) > CAPTURE_STATS_TASKINGS:
+            self.recent_stats.popitem(last=False)
+        # Taskings that are no longer swept give back the memory of buckets they don't need
+        for stats in self.recent_stats.values():
+            stats.expire(time.time())
+
+        # soapy_power is a python script, stop it block buffering its output into our pipe
+        self.process = subprocess.Popen(
+            soapy_power_command(*tasking, self.device) + ["--continue"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            bufsize=1,
+            env={**os.environ, "PYTHONUNBUFFERED": "1"},
+        )
+
+        threading.Thread(
+            target=self._read, args=(self.process, tasking, self.stats), daemon=True
+        ).start()
+
+    # Must be called with self.condition held
+    def _stop(self):
+        if self.process is None:
+            return
+
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+        self.process = None
+        self.condition.notify_all()
+
+    # Must be called with self.condition held. Returns the completed sweep, if there was one
+    def _complete_sweep(self):
+        if len(self.rows) > 0:
+            now = time.time()
+            self.sweep = (now, now - self.sweep_started, list(self.rows))
+            sweep_seconds.observe(self.sweep[1], device=self.device or "default")
+            self.rows.clear()
+            self.condition.notify_all()
+            return self.sweep
+
+    # Bins a completed sweep into the running statistics, outside self.condition
+    def _accumulate(self, stats, sweep):
+        timestamp, _, lines = sweep
+
+        try:
+            with metrics.timed(parse_seconds):
+                bins, bin_powers = bin_sweep(*parse_soapy_power(lines), *stats.tasking[:3])
+        # A bad row mustn't stop the reader thread, which would leave the capture hung
+        except Exception as e:
+            print(f"Error: Unable to add sweep to statistics: {e}")
+            return
+
+        stats.add(timestamp, bin_powers[bins + stats.tasking[2] / 2 < stats.tasking[1]])
+
+    def _read(self, process, tasking, stats):
+        end_hz = tasking[1] * 1e6
+        last_low_hz = None
+
+        for line in process.stdout:
+            completed = []
+
+            parts = line.split(",", 5)
+
+            try:
+                low_hz = float(parts[2])
+                high_hz = float(parts[3])
+            except (IndexError, ValueError):
+                continue
+
+            with self.condition:
+                if self.process is not process:
+                    break
+
+                # The sweep wrapped around without reaching end_hz
+                if last_low_hz is not None and low_hz < last_low_hz:
+                    completed.append(self._complete_sweep())
+
+                if len(self.rows) == 0:
+                    self.sweep_started = time.time()
+
+                self.rows.append(line)
+                last_low_hz = low_hz
+
+                if high_hz >= end_hz:
+                    completed.append(self._complete_sweep())
+                    last_low_hz = None
+
+                    if len(self.waiting) == 0 and time.monotonic() - self.last_request > CAPTURE_IDLE_TIMEOUT_S:
+                        print("Capture idle, closing SDR")
+                        self._stop()
+                        break
+
+            for sweep in completed:
+                if sweep is not None:
+                    self._accumulate(stats, sweep)
+
+        process.wait()
+
+        with self.condition:
+            if self.process is process:
+                self.process = None
+                self.error = f"soapy_power exited with code {process.returncode}"
+                self.condition.notify_all()
+
+
+# Binned results per tasking, least recently used first. Concurrent requests for the
+# same tasking share a single capture instead of each waiting for their own.
+class SweepCache:
+    def __init__(self, max_entries):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.in_flight = {}
+
+    # Returns the cached entry, calling capture(tasking, newer_than) if it is too old
+    def get(self, tasking, max_age_s, capture):
+        with metrics.timed_lock(self.lock, lock_wait_seconds, lock="cache"):
+            entry = self.entries.get(tasking)
+
+            if entry is not None:
+                self.entries.move_to_end(tasking)
+                if time.time() - entry["timestamp"] <= max_age_s:
+                    return entry
+
+            future = self.in_flight.get(tasking)
+            if future is not None:
+                leader = False
+            else:
+                leader = True
+                future = self.in_flight[tasking] = Future()
+
+        if not leader:
+            return future.result()
+
+        try:
+            entry = capture(tasking, entry["timestamp"] if entry is not None else 0)
+
+            with self.lock:
+                self.entries[tasking] = entry
+                self.entries.move_to_end(tasking)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+
+            future.set_result(entry)
+            return entry
+
+        except Exception as e:
+            future.set_exception(e)
+            raise
+
+        finally:
+            with self.lock:
+                del self.in_flight[tasking]
+
+
+capture_workers = {}
+capture_workers_lock = threading.Lock()
+
+
+def get_capture_worker(device):
+    with capture_workers_lock:
+        if device not in capture_workers:
+            capture_workers[device] = CaptureWorker(device)
+        return capture_workers[device]
+
+
+# Splits start_mhz:end_mhz into up to count contiguous ranges on bin boundaries
+def split_tasking(start_mhz, end_mhz, bandwidth_mhz, count):
+    bins = list(range(start_mhz, end_mhz, bandwidth_mhz))
+    count = max(min(count, len(bins)), 1)
+
+    ranges = []
+    for i in range(count):
+        first = bins[i * len(bins) // count]
+        last = bins[(i + 1) * len(bins) // count - 1]
+        ranges.append((first, min(last + bandwidth_mhz, end_mhz)))
+
+    return ranges
+
+
+# tasking is (start_mhz, end_mhz, bandwidth_mhz, profile, devices, measurement) where devices
+# is a tuple of device strings, or (None,) for the default device. The range is split across
+# the devices, swept in parallel and binned together. preempt takes the devices over from
+# requests waiting for other taskings instead of waiting for them to have their sweep.
+def capture_sweep(tasking, newer_than, preempt=False):
+    start_mhz, end_mhz, bandwidth_mhz, profile, devices, measurement = tasking
+    measurement = dict(measurement)
+
+    sources = []
+    for device, (sub_start_mhz, sub_end_mhz) in zip(
+        devices, split_tasking(start_mhz, end_mhz, bandwidth_mhz, len(devices))
+    ):
+        worker = get_capture_worker(device)
+        sub_tasking = (sub_start_mhz, sub_end_mhz, bandwidth_mhz, profile)
+        worker.retask(sub_tasking, preempt)
+        sources.append((device, sub_start_mhz, sub_end_mhz, worker, sub_tasking))
+
+    # Every worker is already sweeping, so waiting on each in turn takes as long as the slowest
+    timestamps = []
+    sweep_durations = []
+    sweep_lines = []
+    for device, _, _, worker, sub_tasking in sources:
+        timestamp, sweep_s, lines = worker.latest_sweep(
+            sub_tasking,
+            SOAPY_POWER_TIMEOUT + plan_sweep(*sub_tasking[:3], dict(profile))["sweep_s"],
+            newer_than,
+        )
+
+        if len(lines) == 0:
+            raise RuntimeError(f"No data from soapy power on {device or 'default device'}")
+
+        timestamps.append(timestamp)
+        sweep_durations.append(sweep_s)
+        sweep_lines.append(lines)
+
+    occupancy = None
+
+    with metrics.timed(parse_seconds):
+        parsed = [parse_soapy_power(lines) for lines in sweep_lines]
+        freqs_mhz = np.concatenate([freqs_mhz for freqs_mhz, _ in parsed])
+        powers_db = np.concatenate([powers_db for _, powers_db in parsed])
+
+        if measurement["mode"] == "noise_floor":
+            bins, bin_powers, occupancy = noise_floor_sweep(
+                freqs_mhz,
+                powers_db,
+                start_mhz,
+                end_mhz,
+                bandwidth_mhz,
+                measurement["percentile"],
+                measurement["occupancy_threshold_db"],
+            )
+        else:
+            bins, bin_powers = bin_sweep(freqs_mhz, powers_db, start_mhz, end_mhz, bandwidth_mhz)
+
+    # Drop the last bin if its centre is past the end of the tasking
+    bin_powers = bin_powers[bins + bandwidth_mhz / 2 < end_mhz]
+    if occupancy is not None:
+        occupancy = occupancy[bins + bandwidth_mhz / 2 < end_mhz]
+
+    for i, power in enumerate(bin_powers.tolist()):
+        if not math.isnan(power):
+            print(f"{start_mhz + (i + 0.5) * bandwidth_mhz}MHz: {round(power, 3)}dBm")
+
+    return {
+        # Identifies this sweep of this tasking in ETag and If-None-Match
+        "etag": f"{zlib.crc32(repr(tasking).encode()):08x}-{min(timestamps):.3f}",
+        # A merged sweep is only as fresh as its oldest part
+        "timestamp": min(timestamps),
+        "sweep_s": max(sweep_durations),
+        "first_freq_mhz": start_mhz + bandwidth_mhz / 2,
+        "step_mhz": bandwidth_mhz,
+        "profile": profile,
+        "powers": bin_powers,
+        "occupancy": occupancy,
+        "sources": [(device, first, last) for device, first, last, _, _ in sources],
+    }
+
+
+# Returns statistics over the last window_s for every bin of sweep, as named in POWER_STATS_PLANES
+def sweep_stats(sweep, window_s):
+    now = time.time()
+
+    parts = []
+    for device, first, last in sweep["sources"]:
+        worker = get_capture_worker(device)
+        with worker.condition:
+            stats = worker.recent_stats.get((first, last, sweep["step_mhz"], sweep["profile"]))
+
+        if stats is None:
+            raise RuntimeError("Tasking changed during capture")
+
+        parts.append(stats.window(window_s, now))
+
+    stats = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    stats["power_dbm"] = sweep["powers"]
+
+    if len(stats["mean_dbm"]) != len(sweep["powers"]):
+        raise RuntimeError("Tasking changed during capture")
+
+    return stats
+
+
+def power_json(sweep, stats=None):
+    stats_lists = {}
+    if stats is not None:
+        stats_lists = {name: stats[name].tolist() for name in POWER_STATS_PLANES if name != "power_dbm"}
+
+    occupancy = sweep["occupancy"].tolist() if sweep["occupancy"] is not None else None
+
+    data = []
+    for i, power in enumerate(sweep["powers"].tolist()):
+        if not math.isnan(power):
+            freq = round(sweep["first_freq_mhz"] + i * sweep["step_mhz"], 3)
+            bin_data = {
+                "freq_mhz": freq,
+                "power_dbm": round(power, 3),
+            }
+
+            for name, values in stats_lists.items():
+                if name == "sweeps":
+                    bin_data[name] = int(values[i])
+                elif math.isfinite(values[i]):
+                    bin_data[name] = round(values[i], 3)
+
+            if occupancy is not None:
+                bin_data["occupancy"] = round(occupancy[i], 3)
+
+            # Say which SDR measured the bin when one was picked
+            for device, first, last in sweep["sources"]:
+                if device is not None and first <= freq < last:
+                    bin_data["device"] = device
+
+            data.append(bin_data)
+    return data
+
+
+def power_binary(sweep, stats=None):
+    occupancy = [sweep["occupancy"]] if sweep["occupancy"] is not None else []
+
+    if stats is not None:
+        planes = [stats[name] for name in POWER_STATS_PLANES] + occupancy
+        return POWER_STATS_HEADER.pack(
+            POWER_STATS_MAGIC, sweep["first_freq_mhz"], sweep["step_mhz"], len(sweep["powers"]), len(planes)
+        ) + np.stack(planes).astype("<f4").tobytes()
+
+    return POWER_HEADER.pack(
+        POWER_OCCUPANCY_MAGIC if len(occupancy) > 0 else POWER_MAGIC,
+        sweep["first_freq_mhz"],
+        sweep["step_mhz"],
+        len(sweep["powers"]),
+    ) + np.stack([sweep["powers"]] + occupancy).astype("<f4").tobytes()
+
+
+sweep_cache = SweepCache(SWEEP_CACHE_MAX_ENTRIES)
+
+sent_sweeps = OrderedDict()
+sent_sweeps_lock = threading.Lock()
+
+
+def remember_sent(sweep):
+    with sent_sweeps_lock:
+        sent_sweeps[sweep["etag"]] = sweep
+        sent_sweeps.move_to_end(sweep["etag"])
+        while len(sent_sweeps) > SENT_SWEEPS_MAX_ENTRIES:
+            sent_sweeps.popitem(last=False)
+
+
+# Returns the ETag of the sweep the client already has if sweep doesn't differ from it by
+# more than deadband_db in any bin, and it isn't older than max_silence_s
+def unchanged_since(etags, sweep, deadband_db, max_silence_s):
+    if sweep["etag"] in etags:
+        return sweep["etag"]
+
+    if deadband_db <= 0:
+        return None
+
+    with sent_sweeps_lock:
+        sent = [sent_sweeps[etag] for etag in etags if etag in sent_sweeps]
+
+    for baseline in sent:
+        if time.time() - baseline["timestamp"] > max_silence_s:
+            continue
+        if baseline["powers"].shape != sweep["powers"].shape:
+            continue
+
+        # Bins must have data in both or neither
+        if not np.array_equal(np.isnan(baseline["powers"]), np.isnan(sweep["powers"])):
+            continue
+
+        if np.nanmax(np.abs(sweep["powers"] - baseline["powers"]), initial=0) <= deadband_db:
+            return baseline["etag"]
+
+    return None
+
+
+# Devices can be given by their index in /devices or as a SoapySDR device string
+def resolve_device(device):
+    if type(device) == int:
+        devices = detect_devices()
+        if device < 0 or device >= len(devices):
+            raise ValueError(f"No device {device}, {len(devices)} detected")
+        return devices[device]
+
+    if type(device) == str and len(device.strip()) > 0:
+        return device.strip()
+
+    raise ValueError("Invalid device")
+
+
+# The detected device that soapy_power would open for device, so the same SDR always gets the
+# same capture worker. soapy_power opens the first device when given none, and the first match
+# of a partial selector such as "driver=rtlsdr". Devices that weren't detected are left as is.
+def physical_device(device):
+    try:
+        devices = detect_devices()
+    except Exception:
+        return device
+
+    if device is None:
+        return devices[0] if len(devices) > 0 else None
+
+    wanted = set(device.replace(", ", ",").split(","))
+    for detected in devices:
+        if wanted <= set(detected.split(",")):
+            return detected
+
+    return device
+
+
+@app.route("/devices")
+def devices_endpoint():
+    try:
+        return api_response(detect_devices(request.args.get("refresh") == "1"))
+
+    except Exception as e:
+        print(f"Error: {e}")
+
+        return api_response({"error": f"{e}"}, 500)
+
+
 @app.route("/power", methods=["POST"])
 def data():
     request_data = request.json
@@ -56,86 +902,175 @@ def data():
             {"error": " bandwidth_mhz must be between 1 and 20 mhz"}, 500
         )
 
-    print(f"Running soapy power {start_mhz}MHz:{end_mhz}MHz {bandwidth_mhz}MHz")
+    max_age_s = request_data.get("max_age_s", SWEEP_CACHE_MAX_AGE_S)
 
-    try:
-        soapy_power_cmd = [
-            "soapy_power",
-            "-k",
-            f"{CROP_PERCENT}",
-            "-f",
-            f"{start_mhz}M:{end_mhz}M",
-            "-r",
-            f"{bandwidth_mhz}M",
-            "-g",
-            f"{GAIN}",
-            "-D",
-            "constant",
-            "-b",
-            f"{FFT_BINS}",
-            "--fft-window",
-            "bartlett",
-        ]
+    if type(max_age_s) not in (int, float) or max_age_s < 0:
+        return api_response({"error": "Invalid max_age_s"}, 500)
 
-        with soapy_power_lock:
-            result = subprocess.run(
-                soapy_power_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.DEVNULL,
-                text=True,
-                timeout=SOAPY_POWER_TIMEOUT,
-            )
+    # Optional, answer 304 Not Modified to an If-None-Match of an earlier sweep unless a bin has
+    # moved more than deadband_db since, or it is more than max_silence_s old
+    deadband_db = request_data.get("deadband_db", 0)
+    max_silence_s = request_data.get("max_silence_s", 3600)
 
-        bins = np.arange(start_mhz, end_mhz, bandwidth_mhz)
-        bin_lin_power_totals = np.zeros_like(bins, dtype=np.float32)
-        bin_counts = np.zeros_like(bins, dtype=np.uint)
+    if type(deadband_db) not in (int, float) or deadband_db < 0:
+        return api_response({"error": "Invalid deadband_db"}, 500)
+    if type(max_silence_s) not in (int, float) or max_silence_s < 0:
+        return api_response({"error": "Invalid max_silence_s"}, 500)
 
-        lines = result.stdout.splitlines()
+    # Optional, also return statistics of every sweep of the last window_s seconds
+    window_s = request_data.get("window_s")
 
-        if len(lines) == 0:
-            raise RuntimeError("No data from soapy power")
+    if window_s is not None and (
+        type(window_s) not in (int, float) or window_s <= 0 or window_s > STATS_BUCKET_S * STATS_BUCKETS
+    ):
+        return api_response(
+            {"error": f"window_s must be between 0 and {STATS_BUCKET_S * STATS_BUCKETS} seconds"}, 500
+        )
 
-        for line in lines:
+    # Optional, start sweeping this tasking straight away rather than after the sweeps other
+    # requests are waiting for, which then fail. For a server whose tasking has just changed
+    preempt = request_data.get("preempt", False)
 
-            parts = line.split(",")
+    if type(preempt) != bool:
+        return api_response({"error": "Invalid preempt"}, 500)
 
-            fft_start_mhz = float(parts[2]) * 1e-6
-            fft_step_mhz = float(parts[4]) * 1e-6
+    # Optional FFT and averaging settings, and how bins are measured, see capture_profile.py
+    try:
+        profile = tuple(sorted(validate_profile(request_data.get("profile")).items()))
+        measurement = tuple(sorted(validate_measurement(request_data.get("measurement")).items()))
+    except ValueError as e:
+        return api_response({"error": f"{e}"}, 500)
 
-            for i, power in enumerate(parts[6:]):
-                freq = fft_start_mhz + (i + 0.5) * fft_step_mhz
+    # Either a single "device", or "devices" to split the range across: a list, or "all"
+    device = request_data.get("device")
+    devices = request_data.get("devices", default_devices)
 
-                b = np.digitize(freq, bins) - 1
+    try:
+        if device is not None:
+            devices = (resolve_device(device),)
+        elif devices == "all":
+            devices = tuple(detect_devices())
+            if len(devices) == 0:
+                raise RuntimeError("No SDRs detected")
+        elif type(devices) == list and len(devices) > 0:
+            devices = tuple(resolve_device(d) for d in devices)
+        elif devices is None:
+            devices = (None,)
+        else:
+            raise ValueError("devices must be a non-empty list or \"all\"")
 
-                if b < len(bins):
-                    bin_lin_power_totals[b] += math.pow(10, float(power) / 10)
-                    bin_counts[b] += 1
+        # One capture worker per SDR, however it was asked for
+        devices = tuple(physical_device(d) for d in devices)
+        if len(set(devices)) < len(devices):
+            raise ValueError("devices lists the same SDR more than once")
+    except Exception as e:
+        return api_response({"error": f"{e}"}, 500)
 
-        bin_lin_powers = bin_lin_power_totals / bin_counts
-        bin_powers = 10 * np.log10(bin_lin_powers)
+    print(f"Fetching sweep {start_mhz}MHz:{end_mhz}MHz {bandwidth_mhz}MHz")
 
-        data = []
-        for i in range(0, len(bins)):
-            freq = round(float(bins[i]) + bandwidth_mhz / 2, 3)
-            power = round(float(bin_powers[i]), 3)
+    try:
+        sweep = sweep_cache.get(
+            (start_mhz, end_mhz, bandwidth_mhz, profile, devices, measurement),
+            max_age_s,
+            lambda tasking, newer_than: capture_sweep(tasking, newer_than, preempt),
+        )
+        stats = sweep_stats(sweep, window_s) if window_s is not None else None
 
-            if not math.isnan(power) and freq < end_mhz:
-                data.append(
-                    {
-                        "freq_mhz": freq,
-                        "power_dbm": power,
-                    }
-                )
+        # Statistics move on with every request so are always sent
+        etag = None
+        if stats is None:
+            etag = unchanged_since(request.if_none_match.as_set(), sweep, deadband_db, max_silence_s)
 
-                print(f"{freq}MHz: {power}dBm")
+        if etag is not None:
+            response = api_response("", 304)
+            response.set_etag(etag)
+        elif request.accept_mimetypes.best_match(["application/json", POWER_MIME_TYPE]) == POWER_MIME_TYPE:
+            response = api_response(power_binary(sweep, stats))
+            response.headers["Content-Type"] = POWER_MIME_TYPE
+            response_bytes.observe(response.content_length, format="binary")
+        else:
+            response = api_response(power_json(sweep, stats))
+            response_bytes.observe(response.content_length, format="json")
 
-        return api_response(data)
+        if etag is None and stats is None:
+            response.set_etag(sweep["etag"])
+            remember_sent(sweep)
+
+        # Let the caller tell a fresh capture from a cached one
+        response.headers["X-Capture-Timestamp"] = f"{sweep['timestamp']:.3f}"
+        response.headers["X-Sweep-Duration"] = f"{sweep['sweep_s']:.3f}"
+        response.headers["Age"] = f"{int(max(time.time() - sweep['timestamp'], 0))}"
+        response.headers["X-Devices"] = ";".join(
+            f"{device or 'default'}@{first}-{last}" for device, first, last in sweep["sources"]
+        )
+        response.headers["Access-Control-Expose-Headers"] = "X-Capture-Timestamp, X-Sweep-Duration, Age, X-Devices, ETag"
+        power_requests.inc(status="ok" if etag is None else "not_modified")
+        return response
 
     except Exception as e:
         print(f"Error: {e}")
+        power_requests.inc(status="error")
 
         return api_response({"error": f"{e}"}, 500)
 
 
+@app.route("/metrics")
+def metrics_endpoint():
+    response = make_response(metrics.render())
+    response.headers["Content-Type"] = metrics.CONTENT_TYPE
+    return response
+
+
 if __name__ == "__main__":
-    serve(app, host="0.0.0.0", port=8080)
+    parser = argparse.ArgumentParser(description="DORA node")
+    parser.add_argument(
+        "--split",
+        action="store_true",
+        help="split requests that don't pick a device across every attached SDR",
+    )
+    parser.add_argument(
+        "--listen",
+        default="0.0.0.0:8080",
+        help="address:port to serve on, several can be given separated by spaces",
+    )
+    parser.add_argument(
+        "--no-metrics",
+        action="store_true",
+        help="don't collect the timings and counts served by /metrics",
+    )
+    parser.add_argument(
+        "--simulate",
+        action="store_true",
+        help="sweep with sdr_simulator.py instead of an SDR",
+    )
+    parser.add_argument("--sim-noise-dbm", type=float, default=-100)
+    parser.add_argument("--sim-spur", action="append", default=[], metavar="MHZ:DBM")
+    parser.add_argument("--sim-hop-s", type=float, default=0.01)
+    parser.add_argument("--sim-startup-s", type=float, default=1)
+    parser.add_argument("--sim-devices", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.split:
+        default_devices = "all"
+
+    if args.no_metrics:
+        metrics.enabled = False
+
+    if args.simulate:
+        soapy_power_program = [
+            sys.executable,
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "sdr_simulator.py"),
+            "--noise-dbm",
+            f"{args.sim_noise_dbm}",
+            "--hop-s",
+            f"{args.sim_hop_s}",
+            "--startup-s",
+            f"{args.sim_startup_s}",
+            "--devices",
+            f"{args.sim_devices}",
+        ]
+        for spur in args.sim_spur:
+            soapy_power_program += ["--spur", spur]
+
+    # waitress counts each listening socket and its wakeup pipe against the connection limit, default 100
+    serve(app, listen=args.listen, connection_limit=100 + 2 * len(args.listen.split()))
@@ -0,0 +1,110 @@
+# Stands in for soapy_power when there is no SDR attached. It takes the same arguments
+# node.py passes to soapy_power and prints rows in the same CSV format, with a noise floor,
+# optional spurs and realistic timing, so nodes and servers can be run and load tested
+# on any machine:
+#
+#   python3 node.py --simulate --sim-spur 433.92:-60
+
+import argparse
+import datetime
+import sys
+import time
+import zlib
+
+import numpy as np
+
+
+def parse_mhz(value):
+    return float(value.upper().rstrip("M"))
+
+
+def parse_spur(value):
+    freq_mhz, power_dbm = value.split(":")
+    return float(freq_mhz), float(power_dbm)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Simulated soapy_power")
+
+    # The soapy_power arguments node.py uses
+    parser.add_argument("-f", "--freq", default="100M:200M")
+    parser.add_argument("-r", "--rate", type=parse_mhz, default=2)
+    parser.add_argument("-b", "--bins", type=int, default=512)
+    parser.add_argument("-k", "--crop", type=float, default=0)
+    parser.add_argument("-t", "--time", type=float, default=None)
+    parser.add_argument("-g", "--gain", type=float, default=0)
+    parser.add_argument("-d", "--device", default="")
+    parser.add_argument("-D", "--remove-dc", default=None)
+    parser.add_argument("--fft-window", default="hann")
+    parser.add_argument("-c", "--continue", dest="continuous", action="store_true")
+    parser.add_argument("--detect", action="store_true")
+
+    # What to simulate
+    parser.add_argument("--noise-dbm", type=float, default=-100, help="noise floor of each FFT bin")
+    parser.add_argument("--noise-std-db", type=float, default=1.5)
+    parser.add_argument(
+        "--spur", type=parse_spur, action="append", default=[], metavar="MHZ:DBM", help="add a carrier"
+    )
+    parser.add_argument("--hop-s", type=float, default=0.01, help="time per hop without -t")
+    parser.add_argument("--startup-s", type=float, default=1, help="time to open the SDR")
+    parser.add_argument("--devices", type=int, default=1, help="number of SDRs --detect reports")
+
+    return parser.parse_args(argv)
+
+
+def sweep_rows(args, rng):
+    start_mhz, end_mhz = (parse_mhz(f) for f in args.freq.split(":"))
+    rate_hz = args.rate * 1e6
+    step_hz = rate_hz / args.bins
+    kept_bins = max(int(args.bins * (1 - args.crop / 100)), 1)
+    hop_hz = kept_bins * step_hz
+    spurs = np.array(args.spur).reshape(-1, 2)
+
+    low_hz = start_mhz * 1e6
+    while low_hz < end_mhz * 1e6:
+        powers = np.power(10.0, rng.normal(args.noise_dbm, args.noise_std_db, kept_bins) / 10)
+
+        # Each carrier lands in the FFT bin that contains it
+        for freq_mhz, power_dbm in spurs:
+            spur_bin = int((freq_mhz * 1e6 - low_hz) // step_hz)
+            if 0 <= spur_bin < kept_bins:
+                powers[spur_bin] += 10 ** (power_dbm / 10)
+
+        now = datetime.datetime.now()
+        yield (
+            f"{now:%Y-%m-%d}, {now:%H:%M:%S.%f}, {low_hz:.0f}, {low_hz + hop_hz:.0f}, {step_hz:.2f}, {args.bins}, "
+            + ", ".join(f"{p:.2f}" for p in (10 * np.log10(powers)).tolist())
+        )
+
+        low_hz += hop_hz
+
+
+def main(argv):
+    args = parse_args(argv)
+
+    if args.detect:
+        print("Detected SoapySDR devices:")
+        for i in range(args.devices):
+            print(f"  driver=simulated, serial={i:04d}")
+        return
+
+    # Each device gets its own noise
+    rng = np.random.default_rng(zlib.crc32(args.device.encode()))
+    hop_s = args.time if args.time is not None else args.hop_s
+
+    time.sleep(args.startup_s)
+
+    while True:
+        for row in sweep_rows(args, rng):
+            time.sleep(hop_s)
+            print(row, flush=True)
+
+        if not args.continuous:
+            break
+
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+    except (BrokenPipeError, KeyboardInterrupt):
+        pass
@@ -1,31 +1,154 @@
+import argparse
+import asyncio
+import csv
 import curses
+import functools
+import gzip
+import heapq
+import io
 import json
 import math
+import multiprocessing
+import os
+import queue
+import random
+import shutil
 import signal
+import socket
+import sqlite3
+import struct
+import sys
+import tempfile
 import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
+import zlib
+from collections import OrderedDict, deque
+from itertools import count
+from contextlib import closing
+from multiprocessing import shared_memory
+from types import MappingProxyType
+
+import aiohttp
+import numpy as np
 import requests
 import urllib3
 from flask import Flask, request, make_response
 from waitress import serve
 
+import metrics
+from capture_profile import fit_profile, plan_sweep, validate_measurement, validate_profile
+
 CONFIG_FILE = "config.json"
-DATA_COLLECTION_INTERVAL_S = 5
+# Config changes are written back to disk after this delay so bursts of edits share one write
+CONFIG_WRITE_DELAY_S = 1
 
 REQUEST_TIMEOUT_S = 10
 REQUEST_VERIFY_SSL = True
-
-data = []
-data_lock = threading.Lock()
-config_lock = threading.Lock()
+# Aggregators answer with every node they collect, which takes a while over a slow link
+AGGREGATE_TIMEOUT_S = 60
+
+# Long polls on /data hold a thread each, so serve with more than waitress' default 4
+SERVE_THREADS = 32
+DATA_LONG_POLL_MAX_S = 30
+# Long polls past this many at once are answered straight away, so they can't take every thread
+DATA_LONG_POLL_MAX_WAITERS = SERVE_THREADS // 2
+# Removed nodes remembered for /data?since= before clients are sent a full response instead
+REGISTRY_MAX_TOMBSTONES = 1000
+
+# Mean earth radius used for distances between nodes
+EARTH_RADIUS_M = 6371000
+# Node positions are indexed in cells this many degrees square, so /query only looks at
+# nodes near the area asked for
+SPATIAL_CELL_DEG = 0.1
+
+# Largest interpolated grid /query will work out, in grid points and in frequencies times grid points
+QUERY_MAX_GRID_VALUES = 1000000
+# Inverse distance weighting power used to interpolate /query grids
+QUERY_IDW_POWER = 2
+
+# With --collectors, nodes are polled and their responses decoded in worker processes. Each
+# worker hands sweeps back through a shared memory matrix of (frequencies, noise, occupancy) x
+# one slot per request in flight x this many bins. Larger sweeps go through a queue instead.
+COLLECTOR_SHM_MAX_BINS = 16384
+
+# With --api-workers, /data is also served by worker processes on --api-listen. They read
+# every node's latest measurement from shared memory, which the server rewrites at most this
+# often. It starts with room for this many bins across all nodes and this many bytes of index,
+# and is replaced by one twice the size whenever they run out
+API_PUBLISH_INTERVAL_S = 0.2
+API_SHM_BINS = 1 << 21
+API_SHM_INDEX_BYTES = 16 << 20
+# Shared memory header: sequence number, odd while being rewritten, index length, revision,
+# config version, 1 once replaced (the index then holds the new one's name), index capacity
+# and bin capacity, as int64
+API_SHM_HEADER_VALUES = 7
+# How often API workers look for a new revision while long polling
+API_LONG_POLL_CHECK_S = 0.05
+
+# Upper bound on node requests in flight at once
+COLLECT_MAX_CONCURRENT = 100
+# New nodes get their first poll at a random point in this window
+COLLECT_JITTER_S = 1
+# and every node is polled within this window of a tasking change
+COLLECT_RETASK_JITTER_S = 0.1
+# Each node is polled as often as it completes sweeps, within these limits
+COLLECT_MIN_INTERVAL_S = 1
+COLLECT_MAX_INTERVAL_S = 60
+# Failing nodes back off exponentially up to COLLECT_BACKOFF_MAX_S. After
+# COLLECT_CIRCUIT_FAILURES failures in a row they are only retried every COLLECT_CIRCUIT_OPEN_S.
+COLLECT_BACKOFF_MAX_S = 300
+COLLECT_CIRCUIT_FAILURES = 10
+COLLECT_CIRCUIT_OPEN_S = 900
+# Idle connections to nodes are kept open across rounds for this long
+COLLECT_KEEPALIVE_S = 30
+
+# Measurements are posted to CloudRF in batches of up to this many, or whatever
+# has arrived once the oldest measurement has waited UPLOAD_BATCH_MAX_WAIT_S
+UPLOAD_BATCH_SIZE = 5000
+UPLOAD_BATCH_MAX_WAIT_S = 5
+UPLOAD_QUEUE_SIZE = 10000
+UPLOAD_MAX_ATTEMPTS = 5
+UPLOAD_BACKOFF_S = 1
+UPLOAD_BACKOFF_MAX_S = 60
+# Batches that can't be posted are kept here and replayed once CloudRF is reachable
+UPLOAD_JOURNAL_FILE = "cloudrf_journal.jsonl"
+# Batches the API refused are kept here instead, as sending them again won't help
+UPLOAD_REJECTED_FILE = "cloudrf_rejected.jsonl"
+UPLOAD_JOURNAL_MAX_BYTES = 100 * 1024 * 1024
+
+HISTORY_FILE = "history.sqlite"
+HISTORY_QUEUE_SIZE = 1000
+HISTORY_PRUNE_INTERVAL_S = 600
+HISTORY_RAW_RETENTION_S = 6 * 3600
+# Roll-up tables: name, bucket size and retention
+HISTORY_ROLLUPS = {
+    "1m": (60, 7 * 24 * 3600),
+    "15m": (900, 30 * 24 * 3600),
+    "1h": (3600, 365 * 24 * 3600),
+}
+# /history refuses queries that would return more rows than this
+HISTORY_MAX_ROWS = 200000
+
+config_store = None
+uploader = None
+history = None
+collectors = None
+publisher = None
+# (event loop, asyncio.Event) collect_loop waits on, so other threads can wake it
+collect_wakeup = None
 app = Flask(__name__)
 
 win = None
 log_win = None
 
-log = []
+# Appending to a deque is atomic so producers never wait on the console. Each line
+# carries a sequence number so the render loop can tell what it hasn't shown yet.
+LOG_MAX_LINES = 1000
+log = deque(maxlen=LOG_MAX_LINES)
+log_seq = count(1)
+
+# The console is redrawn at most this many times a second, and only if something changed
+RENDER_FPS = 4
 
 COLOR_RED = 1
 COLOR_YELLOW = 2
@@ -34,18 +157,1045 @@ COLOR_GREEN = 3
 CLOUDRF_NOISE_MAX = -20
 CLOUDRF_NOISE_MIN = -144
 
+# Compact /power response format, see POWER_HEADER in node.py
+POWER_MIME_TYPE = "application/x-dora-power"
+POWER_MAGIC = b"DOR1"
+POWER_OCCUPANCY_MAGIC = b"DOR3"
+POWER_HEADER = struct.Struct("<4sddI")
+
+
+node_request_seconds = metrics.Histogram(
+    "dora_server_node_request_seconds", "Time taken to poll each node", ("node",)
+)
+node_errors = metrics.Counter("dora_server_node_errors_total", "Failed polls of each node", ("node",))
+config_io_seconds = metrics.Histogram(
+    "dora_server_config_io_seconds", "Time taken to read and write config.json", ("op",)
+)
+upload_seconds = metrics.Histogram(
+    "dora_server_cloudrf_upload_seconds", "Time taken by each post to the CloudRF API"
+)
+upload_errors = metrics.Counter("dora_server_cloudrf_upload_errors_total", "Failed posts to the CloudRF API")
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    if isinstance(value, MappingProxyType):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+
+# Holds config.json in memory. Readers take an immutable snapshot without locking,
+# writers hold self.lock, edit a copy and commit it as a new version.
+class ConfigStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.write_timer = None
+
+        with metrics.timed(config_io_seconds, op="read"), open(path, "r") as f:
+            self.current = (0, freeze(json.load(f)))
+
+    @property
+    def version(self):
+        return self.current[0]
+
+    def snapshot(self):
+        return self.current[1]
+
+    # Must be called with self.lock held
+    def copy(self):
+        return thaw(self.current[1])
+
+    # Must be called with self.lock held
+    def commit(self, config):
+        self.current = (self.current[0] + 1, freeze(config))
+
+        if self.write_timer is None:
+            self.write_timer = threading.Timer(CONFIG_WRITE_DELAY_S, self.flush)
+            self.write_timer.daemon = True
+            self.write_timer.start()
+
+    def flush(self):
+        with self.write_lock, metrics.timed(config_io_seconds, op="write"):
+            with self.lock:
+                self.write_timer = None
+                version, config = self.current
+
+            # Write to a temporary file and rename it over the old one so a crash
+            # can never leave a half written config behind
+            directory = os.path.dirname(os.path.abspath(self.path))
+            with tempfile.NamedTemporaryFile(
+                "w", dir=directory, prefix=".config-", suffix=".tmp", delete=False
+            ) as f:
+                f.write(json.dumps(thaw(config)))
+                f.flush()
+                os.fsync(f.fileno())
+
+            if os.path.exists(self.path):
+                shutil.copymode(self.path, f.name)
+
+            os.replace(f.name, self.path)
+
+
+def spatial_cell(latitude, longitude):
+    return math.floor(latitude / SPATIAL_CELL_DEG), math.floor(longitude / SPATIAL_CELL_DEG)
+
+
+# Great circle distance in metres between positions in radians, any of which can be arrays
+def haversine_m(latitude_a, longitude_a, latitude_b, longitude_b):
+    a = (
+        np.sin((latitude_b - latitude_a) / 2) ** 2
+        + np.cos(latitude_a) * np.cos(latitude_b) * np.sin((longitude_b - longitude_a) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+# The "data" list of a node in /data. Bins with an occupancy also say how busy they were.
+def measurement_data(frequencies, noise, occupancy):
+    data = [
+        {"frequency": frequency, "noise": noise}
+        for frequency, noise in zip(np.round(frequencies, 3).tolist(), np.round(noise, 3).tolist())
+    ]
+
+    if occupancy is not None:
+        for bin_data, value in zip(data, np.round(occupancy, 3).tolist()):
+            if not math.isnan(value):
+                bin_data["occupancy"] = value
+
+    return data
+
+
+# Every configured node keyed by address, with its latest measurement and health.
+# Callers must hold self.lock.
+#
+# Every change visible in /data bumps self.revision and notifies self.changed. Revisions
+# start from the current time in milliseconds so they keep increasing across restarts.
+class NodeRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.nodes = {}
+        # Addresses of the nodes in each SPATIAL_CELL_DEG cell, keyed by (row, column)
+        self.cells = {}
+        # Nodes within this many metres of each other split the tasking between them, 0 to disable
+        self.shard_radius_m = 0
+        # Bumped whenever nodes are added or removed
+        self.membership = 0
+        # Bumped whenever the tasking changes
+        self.tasking = 0
+        self.revision = int(time.time() * 1000)
+        # Clients that last saw a revision older than this need everything again
+        self.full_revision = self.revision
+        self.removed = OrderedDict()
+        # /data requests waiting on self.changed
+        self.long_polls = 0
+
+    def _bump(self):
+        self.revision += 1
+        self.changed.notify_all()
+        return self.revision
+
+    def __contains__(self, address):
+        return address in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get(self, address):
+        return self.nodes.get(address)
+
+    # Returns True if the node already existed and its position was updated. Aggregators are
+    # other servers polled for all of their nodes at once, which are added here with via set
+    # to the aggregator's address. Pass regroup=False when changing many nodes and call
+    # regroup() once afterwards.
+    def add(self, address, latitude, longitude, aggregator=False, via=None, regroup=True):
+        node = self.nodes.get(address)
+
+        if node is None:
+            self.nodes[address] = {
+                "address": address,
+                "latitude": latitude,
+                "longitude": longitude,
+                "frequencies": None,
+                "noise": None,
+                # Fraction of each bin's FFT values well above its noise floor, from nodes
+                # measuring in noise_floor mode, otherwise None
+                "occupancy": None,
+                "measurement": None,
+                "capture_timestamp": None,
+                "sweep_s": None,
+                "last_success": None,
+                "last_error": None,
+                "failures": 0,
+                # Addresses of the nodes sharing the tasking with this one, and this node's (index, count)
+                "cluster": [address],
+                "shard": (0, 1),
+                # ETag of the sweep we have from the node, sent back in If-None-Match. For
+                # aggregators, the revision of theirs we are up to
+                "etag": None,
+                # (frequencies kHz, noise, time) last posted to CloudRF, sorted by frequency
+                "posted": None,
+                "aggregator": aggregator,
+                "via": via,
+            }
+            self._index(self.nodes[address])
+            self.membership += 1
+            # Nodes behind an aggregator are grouped by their own server
+            if regroup and via is None:
+                self.regroup()
+            return False
+
+        self._unindex(node)
+        node["latitude"] = latitude
+        node["longitude"] = longitude
+        node["aggregator"] = aggregator
+        self._index(node)
+        if node["noise"] is not None:
+            self.set_measurement(address, node["frequencies"], node["noise"], node["occupancy"])
+        if regroup and via is None:
+            self.regroup()
+        return True
+
+    def remove(self, address, regroup=True):
+        node = self.nodes.pop(address, None)
+
+        if node is None:
+            return False
+
+        self._unindex(node)
+        self.membership += 1
+
+        if node["noise"] is not None:
+            self._tombstone(address)
+
+        # Everything collected through an aggregator goes with it
+        for remote in [a for a, other in self.nodes.items() if other["via"] == address]:
+            self.remove(remote)
+
+        if regroup and node["via"] is None:
+            self.regroup()
+        return True
+
+    # Tells /data?since= clients the node has gone
+    def _tombstone(self, address):
+        revision = self.removed[address] = self._bump()
+
+        while len(self.removed) > REGISTRY_MAX_TOMBSTONES:
+            _, oldest = self.removed.popitem(last=False)
+            self.full_revision = oldest
+
+        return revision
+
+    def sync(self, sdrs):
+        nodes = {}
+        for sdr in sdrs:
+            node = self.nodes.get(sdr["address"])
+            if node is None:
+                self.add(sdr["address"], sdr["latitude"], sdr["longitude"], sdr.get("aggregator", False))
+                node = self.nodes[sdr["address"]]
+            nodes[sdr["address"]] = node
+        nodes.update({a: node for a, node in self.nodes.items() if node["via"] in nodes})
+        self.nodes = nodes
+        self.cells = {}
+        for node in nodes.values():
+            self._index(node)
+        self.membership += 1
+        self.regroup()
+
+    def _index(self, node):
+        cell = spatial_cell(node["latitude"], node["longitude"])
+        self.cells.setdefault(cell, set()).add(node["address"])
+
+    def _unindex(self, node):
+        cell = spatial_cell(node["latitude"], node["longitude"])
+        self.cells[cell].discard(node["address"])
+        if len(self.cells[cell]) == 0:
+            del self.cells[cell]
+
+    # Returns the nodes inside a latitude/longitude box
+    def within(self, min_latitude, min_longitude, max_latitude, max_longitude):
+        min_row, min_column = spatial_cell(min_latitude, min_longitude)
+        max_row, max_column = spatial_cell(max_latitude, max_longitude)
+
+        # Large areas have fewer occupied cells than cells
+        if (max_row - min_row + 1) * (max_column - min_column + 1) > len(self.cells):
+            cells = [
+                addresses
+                for (row, column), addresses in self.cells.items()
+                if min_row <= row <= max_row and min_column <= column <= max_column
+            ]
+        else:
+            cells = [
+                self.cells[(row, column)]
+                for row in range(min_row, max_row + 1)
+                for column in range(min_column, max_column + 1)
+                if (row, column) in self.cells
+            ]
+
+        nodes = [self.nodes[address] for addresses in cells for address in addresses]
+        return [
+            node
+            for node in nodes
+            if min_latitude <= node["latitude"] <= max_latitude and min_longitude <= node["longitude"] <= max_longitude
+        ]
+
+    def set_shard_radius(self, radius_m):
+        self.shard_radius_m = radius_m
+        self.regroup()
+
+    # Groups nodes that are within shard_radius_m of the first node of the group. Each member
+    # sweeps its share of the tasking, and /data shows the group's spectrum stitched together.
+    # Nodes whose circuit is open sweep on their own, so the rest of their group covers their
+    # share until they recover.
+    def regroup(self):
+        addresses = sorted(a for a, node in self.nodes.items() if not node["aggregator"] and node["via"] is None)
+        latitudes = np.radians([self.nodes[a]["latitude"] for a in addresses])
+        longitudes = np.radians([self.nodes[a]["longitude"] for a in addresses])
+        down = np.array([self.nodes[a]["failures"] >= COLLECT_CIRCUIT_FAILURES for a in addresses], dtype=bool)
+        unassigned = np.ones(len(addresses), dtype=bool)
+        changed = []
+
+        for i, address in enumerate(addresses):
+            if not unassigned[i]:
+                continue
+
+            if self.shard_radius_m > 0 and not down[i]:
+                distance_m = haversine_m(latitudes[i], longitudes[i], latitudes, longitudes)
+                in_group = unassigned & ~down & (distance_m <= self.shard_radius_m)
+            else:
+                in_group = np.zeros(len(addresses), dtype=bool)
+            in_group[i] = True
+            unassigned &= ~in_group
+
+            cluster = [addresses[j] for j in np.flatnonzero(in_group)]
+            for index, member in enumerate(cluster):
+                node = self.nodes[member]
+                if node["cluster"] != cluster:
+                    changed.append(node)
+                node["cluster"] = cluster
+                node["shard"] = (index, len(cluster))
+
+        # The stitched spectrum of anything with data in a group that changed is now different
+        changed = [node for node in changed if node["noise"] is not None]
+        if len(changed) > 0:
+            revision = self._bump()
+            for node in changed:
+                node["measurement"] = None
+                node["revision"] = revision
+
+    # Measurements are kept as NumPy arrays. The dict sent by /data is only built when first
+    # asked for and is replaced rather than modified so it can be serialised outside the lock.
+    def set_measurement(self, address, frequencies, noise, occupancy=None):
+        node = self.nodes[address]
+        node["frequencies"] = frequencies
+        node["noise"] = noise
+        node["occupancy"] = occupancy
+        revision = self._bump()
+
+        # Everyone in the group shows the stitched spectrum, so they have all changed
+        for member in node["cluster"]:
+            member = self.nodes.get(member)
+            if member is node or (member is not None and member["noise"] is not None):
+                member["measurement"] = None
+                member["revision"] = revision
+
+        self.removed.pop(address, None)
+
+    # The node answered but had nothing newer than what we already have
+    def record_alive(self, address):
+        node = self.nodes[address]
+        node["last_success"] = time.time()
+        recovered = node["failures"] >= COLLECT_CIRCUIT_FAILURES
+        node["failures"] = 0
+
+        if recovered and node["via"] is None:
+            self.regroup()
+
+    def record_success(self, address, frequencies, noise, capture_timestamp, occupancy=None):
+        self.record_alive(address)
+        self.nodes[address]["capture_timestamp"] = capture_timestamp
+        self.set_measurement(address, frequencies, noise, occupancy)
+
+    def record_error(self, address, error):
+        node = self.nodes[address]
+        node["last_error"] = f"{error}"
+        node["failures"] += 1
+
+        # Hand its share of the tasking to the rest of its group
+        if node["failures"] == COLLECT_CIRCUIT_FAILURES and node["via"] is None:
+            self.regroup()
+
+    def clear_measurements(self):
+        for node in self.nodes.values():
+            node["frequencies"] = None
+            node["noise"] = None
+            node["occupancy"] = None
+            node["measurement"] = None
+
+        self.removed.clear()
+        self.full_revision = self._bump()
+
+    # Keeps the part of every measurement inside the new tasking, with its capture time, so /data
+    # doesn't go blank while nodes sweep the new range. Nodes with nothing left in range look
+    # removed to /data?since= clients until they have. clear drops everything instead, for when
+    # old measurements can't be compared with new ones or would be mixed with bins of another size.
+    def retask(self, start_mhz, end_mhz, clear=False):
+        self.tasking += 1
+
+        if clear:
+            self.clear_measurements()
+            return
+
+        for address, node in self.nodes.items():
+            if node["noise"] is None:
+                continue
+
+            in_tasking = (node["frequencies"] >= start_mhz) & (node["frequencies"] <= end_mhz)
+
+            if np.all(in_tasking):
+                continue
+            elif np.any(in_tasking):
+                occupancy = node["occupancy"][in_tasking] if node["occupancy"] is not None else None
+                self.set_measurement(address, node["frequencies"][in_tasking], node["noise"][in_tasking], occupancy)
+            else:
+                node["frequencies"] = None
+                node["noise"] = None
+                node["occupancy"] = None
+                node["measurement"] = None
+                revision = self._tombstone(address)
+
+                # The rest of its group no longer shows its part of the spectrum
+                for member in node["cluster"]:
+                    member = self.nodes.get(member)
+                    if member is not None and member["noise"] is not None:
+                        member["measurement"] = None
+                        member["revision"] = revision
+
+    # Returns (full, measurements, removed addresses) needed to bring a client at revision since up to date
+    def changes_since(self, since):
+        if since is None or since < self.full_revision or since > self.revision:
+            return True, self.measurements(), []
+
+        measurements = [
+            self._measurement(node)
+            for node in self.nodes.values()
+            if node["noise"] is not None and node["revision"] > since
+        ]
+        removed = [
+            address for address, revision in self.removed.items() if revision > since
+        ]
+
+        return False, measurements, removed
+
+    def measurements(self):
+        return [
+            self._measurement(node)
+            for node in self.nodes.values()
+            if node["noise"] is not None
+        ]
+
+    def _measurement(self, node):
+        if node["measurement"] is None:
+            frequencies, noise, occupancy = self._stitched(node)
+            node["measurement"] = {
+                "address": node["address"],
+                "latitude": node["latitude"],
+                "longitude": node["longitude"],
+                "capture_timestamp": self._captured(node),
+                "data": measurement_data(frequencies, noise, occupancy),
+            }
+            if len(node["cluster"]) > 1:
+                node["measurement"]["cluster"] = node["cluster"]
+            if node["via"] is not None:
+                node["measurement"]["via"] = node["via"]
+        return node["measurement"]
+
+    # Like changes_since, but with each node's own (frequencies, noise, occupancy) arrays for an upstream
+    # server polling /aggregate. The arrays are replaced rather than modified so they can be
+    # serialised outside the lock.
+    def sweeps_since(self, since):
+        full = since is None or since < self.full_revision or since > self.revision
+
+        sweeps = [
+            {
+                "address": node["address"],
+                "latitude": node["latitude"],
+                "longitude": node["longitude"],
+                "capture_timestamp": node["capture_timestamp"],
+                "frequencies": node["frequencies"],
+                "noise": node["noise"],
+                "occupancy": node["occupancy"],
+            }
+            for node in self.nodes.values()
+            if node["noise"] is not None and (full or node["revision"] > since)
+        ]
+        removed = [] if full else [address for address, revision in self.removed.items() if revision > since]
+
+        return full, sweeps, removed
+
+    # Returns the position and (frequencies, noise, occupancy) arrays of every node with a
+    # measurement inside a latitude/longitude box, as shown in /data
+    def sweeps_within(self, min_latitude, min_longitude, max_latitude, max_longitude):
+        sweeps = []
+        for node in self.within(min_latitude, min_longitude, max_latitude, max_longitude):
+            if node["noise"] is None:
+                continue
+            frequencies, noise, occupancy = self._stitched(node)
+            sweeps.append(
+                {
+                    "address": node["address"],
+                    "latitude": node["latitude"],
+                    "longitude": node["longitude"],
+                    "frequencies": frequencies,
+                    "noise": noise,
+                    "occupancy": occupancy,
+                }
+            )
+        return sweeps
+
+    # Every node with a measurement, with the stitched (frequencies, noise, occupancy) arrays
+    # and revision shown in /data, for the API worker processes
+    def stitched_sweeps(self):
+        sweeps = []
+        for node in self.nodes.values():
+            if node["noise"] is None:
+                continue
+            frequencies, noise, occupancy = self._stitched(node)
+            sweep = {
+                "address": node["address"],
+                "latitude": node["latitude"],
+                "longitude": node["longitude"],
+                "capture_timestamp": self._captured(node),
+                "revision": node["revision"],
+                "frequencies": frequencies,
+                "noise": noise,
+                "occupancy": occupancy,
+            }
+            if len(node["cluster"]) > 1:
+                sweep["cluster"] = node["cluster"]
+            if node["via"] is not None:
+                sweep["via"] = node["via"]
+            sweeps.append(sweep)
+        return sweeps
+
+    # Returns when the oldest bins shown for the node's group were captured, or None if its
+    # members don't report it. Bins kept through a retask keep their capture time.
+    def _captured(self, node):
+        timestamps = [
+            self.nodes[address]["capture_timestamp"]
+            for address in node["cluster"]
+            if address in self.nodes and self.nodes[address]["noise"] is not None
+        ]
+        timestamps = [timestamp for timestamp in timestamps if timestamp is not None]
+        return min(timestamps) if len(timestamps) > 0 else None
+
+    # Returns the (frequencies, noise, occupancy) of every member of the node's group, newest
+    # capture first where shards overlap while the group is being rearranged. Occupancy is NaN
+    # for members that don't report it, or None if none of them do.
+    def _stitched(self, node):
+        if len(node["cluster"]) == 1:
+            return node["frequencies"], node["noise"], node["occupancy"]
+
+        members = [self.nodes[address] for address in node["cluster"] if address in self.nodes]
+        members = sorted(
+            (member for member in members if member["noise"] is not None),
+            key=lambda member: member["capture_timestamp"] or 0,
+            reverse=True,
+        )
+        frequencies, first = np.unique(
+            np.concatenate([member["frequencies"] for member in members]), return_index=True
+        )
+        noise = np.concatenate([member["noise"] for member in members])[first]
 
-def draw_log():
-    global log
+        if all(member["occupancy"] is None for member in members):
+            return frequencies, noise, None
+
+        occupancy = np.concatenate(
+            [
+                member["occupancy"] if member["occupancy"] is not None else np.full(len(member["noise"]), np.nan)
+                for member in members
+            ]
+        )[first]
+        return frequencies, noise, occupancy
+
+
+registry = NodeRegistry()
+
+
+# Returns the (start_mhz, end_mhz) swept by shard index of count, split on bandwidth_mhz boundaries
+def shard_tasking(start_mhz, end_mhz, bandwidth_mhz, index, count):
+    bins = list(range(start_mhz, end_mhz, bandwidth_mhz))
+    if len(bins) == 0:
+        return start_mhz, end_mhz
+
+    count = min(count, len(bins))
+    # Groups larger than the number of bins double up
+    index %= count
+
+    first = bins[index * len(bins) // count]
+    last = bins[(index + 1) * len(bins) // count - 1]
+    return first, min(last + bandwidth_mhz, end_mhz)
+
+
+# Raised when the CloudRF API refuses a batch outright, rather than failing to take it
+class UploadRejected(Exception):
+    pass
+
+
+# Posts measurements to the CloudRF noise API from its own thread so a slow or
+# unreachable API never holds up collection.
+class CloudRFUploader:
+    def __init__(self, journal_path, rejected_path):
+        self.queue = queue.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+        self.journal_path = journal_path
+        self.rejected_path = rejected_path
+        self.journal_lock = threading.Lock()
+        # Measurements waiting to be batched, and the batches being posted
+        self.pending = []
+        self.posting = []
+        self.session = requests.Session()
+        self.compress = True
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, measurements):
+        try:
+            self.queue.put_nowait(measurements)
+        except queue.Full:
+            log_msg("CloudRF upload queue full, journaling measurements", COLOR_YELLOW)
+            self._journal(measurements)
+
+    # Journal everything not yet posted so it is replayed on the next start. A batch that
+    # is being posted right now may end up posted twice
+    def close(self):
+        batches = list(self.posting)
+        if len(self.pending) > 0:
+            batches.append(self.pending)
+
+        while True:
+            try:
+                batches.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        for batch in batches:
+            self._journal(batch)
+
+    def _run(self):
+        deadline = None
+
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+
+            try:
+                measurements = self.queue.get(timeout=timeout)
+                if len(self.pending) == 0:
+                    deadline = time.monotonic() + UPLOAD_BATCH_MAX_WAIT_S
+                self.pending.extend(measurements)
+            except queue.Empty:
+                pass
+
+            if len(self.pending) >= UPLOAD_BATCH_SIZE or (
+                deadline is not None and time.monotonic() >= deadline
+            ):
+                pending, self.pending = self.pending, []
+                deadline = None
+
+                self.posting = [
+                    pending[i : i + UPLOAD_BATCH_SIZE] for i in range(0, len(pending), UPLOAD_BATCH_SIZE)
+                ]
+                while len(self.posting) > 0:
+                    self._upload(self.posting[0])
+                    self.posting.pop(0)
+
+    def _upload(self, batch):
+        config = config_store.snapshot()
+
+        # Posting is off without an API, or with it set to null
+        if config.get("cloudrf_api") is None or "cloudrf_api_key" not in config:
+            return
+
+        backoff_s = UPLOAD_BACKOFF_S
+
+        for attempt in range(1, UPLOAD_MAX_ATTEMPTS + 1):
+            try:
+                with metrics.timed(upload_seconds):
+                    self._post(config, batch)
+
+                log_msg(
+                    f"Succesfully posted {len(batch)} noise measurements to {config['cloudrf_api']}"
+                )
+
+                self._replay_journal(config)
+                return
+
+            except UploadRejected as e:
+                upload_errors.inc()
+                self._reject(batch, e)
+                return
+
+            except Exception as e:
+                upload_errors.inc()
+                log_msg(
+                    f"Error posting measurements to {config['cloudrf_api']} (attempt {attempt}/{UPLOAD_MAX_ATTEMPTS}): {e}",
+                    COLOR_RED,
+                )
+
+            if attempt < UPLOAD_MAX_ATTEMPTS:
+                time.sleep(backoff_s * random.uniform(0.5, 1.5))
+                backoff_s = min(backoff_s * 2, UPLOAD_BACKOFF_MAX_S)
+
+        self._journal(batch)
+
+    def _post(self, config, batch):
+        body = json.dumps(batch).encode()
+        headers = {
+            "key": config["cloudrf_api_key"],
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+        }
+
+        if self.compress:
+            response = self.session.post(
+                f"{config['cloudrf_api']}/noise/create",
+                headers={**headers, "Content-Encoding": "gzip"},
+                data=gzip.compress(body),
+                timeout=REQUEST_TIMEOUT_S,
+                verify=REQUEST_VERIFY_SSL,
+            )
+
+            if not self._refused(response):
+                self._check_response(response)
+                return
+
+        response = self.session.post(
+            f"{config['cloudrf_api']}/noise/create",
+            headers=headers,
+            data=body,
+            timeout=REQUEST_TIMEOUT_S,
+            verify=REQUEST_VERIFY_SSL,
+        )
+
+        # Not every deployment accepts compressed bodies, and they don't all refuse them with a 415.
+        # Stop compressing if the batch is only refused compressed
+        if self.compress and not self._refused(response):
+            log_msg("CloudRF API does not accept gzip, sending uncompressed", COLOR_YELLOW)
+            self.compress = False
+
+        self._check_response(response)
+
+    # Client errors won't go away by sending the same batch again, except these two
+    def _refused(self, response):
+        return 400 <= response.status_code < 500 and response.status_code not in (408, 429)
+
+    def _check_response(self, response):
+        response_json = response.json()
+        if self._refused(response):
+            raise UploadRejected(response_json.get("error", f"HTTP {response.status_code}"))
+        if "error" in response_json:
+            raise RuntimeError(response_json["error"])
+        response.raise_for_status()
+
+    def _journal(self, batch, path=None):
+        path = self.journal_path if path is None else path
+
+        with self.journal_lock:
+            try:
+                if os.path.exists(path) and os.path.getsize(path) > UPLOAD_JOURNAL_MAX_BYTES:
+                    raise RuntimeError("journal full")
+
+                with open(path, "a") as f:
+                    f.write(json.dumps(batch) + "\n")
+
+            except Exception as e:
+                log_msg(f"Dropped {len(batch)} noise measurements: {e}", COLOR_RED)
+
+    def _reject(self, batch, error):
+        log_msg(
+            f"CloudRF API refused {len(batch)} noise measurements, keeping them in {self.rejected_path}: {error}",
+            COLOR_RED,
+        )
+        self._journal(batch, self.rejected_path)
+
+    def _replay_journal(self, config):
+        with self.journal_lock:
+            if not os.path.exists(self.journal_path):
+                return
+
+            with open(self.journal_path, "r") as f:
+                lines = f.read().splitlines()
+
+            os.remove(self.journal_path)
+
+        for i, line in enumerate(lines):
+            try:
+                self._post(config, json.loads(line))
+            except UploadRejected as e:
+                self._reject(json.loads(line), e)
+            except Exception as e:
+                log_msg(f"Error replaying journaled measurements: {e}", COLOR_RED)
+
+                for remaining in lines[i:]:
+                    self._journal(json.loads(remaining))
+                return
+
+        log_msg(f"Replayed {len(lines)} journaled batches to {config['cloudrf_api']}", COLOR_GREEN)
+
+
+# Append-only SQLite store of every measurement, rolled up to min/mean/max per
+# HISTORY_ROLLUPS bucket as it is written. Means are taken in the linear power domain.
+# Frequencies are stored as integer kHz and timestamps as integer seconds.
+class HistoryStore:
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.Queue(maxsize=HISTORY_QUEUE_SIZE)
+        self.node_ids = {}
+        self.last_prune = 0
+
+        with closing(self._connect()) as db, db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS nodes (id INTEGER PRIMARY KEY, address TEXT UNIQUE NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS samples_raw (node INTEGER, freq_khz INTEGER, ts INTEGER, dbm REAL, "
+                "occupancy REAL, PRIMARY KEY (node, freq_khz, ts)) WITHOUT ROWID"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS samples_raw_ts ON samples_raw (ts)")
+            # History from before occupancy was kept
+            self._add_column(db, "samples_raw", "occupancy REAL")
+
+            for name in HISTORY_ROLLUPS:
+                # occ_n counts the samples that had an occupancy, so its mean is occ_sum / occ_n
+                db.execute(
+                    f"CREATE TABLE IF NOT EXISTS samples_{name} (node INTEGER, freq_khz INTEGER, ts INTEGER, "
+                    "n INTEGER, min_dbm REAL, lin_sum REAL, max_dbm REAL, "
+                    "occ_sum REAL NOT NULL DEFAULT 0, occ_n INTEGER NOT NULL DEFAULT 0, "
+                    "PRIMARY KEY (node, freq_khz, ts)) WITHOUT ROWID"
+                )
+                db.execute(f"CREATE INDEX IF NOT EXISTS samples_{name}_ts ON samples_{name} (ts)")
+                self._add_column(db, f"samples_{name}", "occ_sum REAL NOT NULL DEFAULT 0")
+                self._add_column(db, f"samples_{name}", "occ_n INTEGER NOT NULL DEFAULT 0")
+
+            for node_id, address in db.execute("SELECT id, address FROM nodes"):
+                self.node_ids[address] = node_id
+
+    def _add_column(self, db, table, column):
+        if column.split()[0] not in [row[1] for row in db.execute(f"PRAGMA table_info({table})")]:
+            db.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=REQUEST_TIMEOUT_S, check_same_thread=False)
+        # Let /history read while the writer thread is writing
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, address, timestamp, frequencies, noise, occupancy=None):
+        try:
+            self.queue.put_nowait((address, int(timestamp), frequencies, noise, occupancy))
+        except queue.Full:
+            log_msg(f"History queue full, dropped measurement from {address}", COLOR_YELLOW)
+
+    def _run(self):
+        db = self._connect()
+
+        while True:
+            # Write everything waiting in a single transaction
+            items = [self.queue.get()]
+            try:
+                while True:
+                    items.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            try:
+                with db:
+                    self._write(db, items)
+
+                    if time.time() - self.last_prune > HISTORY_PRUNE_INTERVAL_S:
+                        self._prune(db)
+                        self.last_prune = time.time()
+
+            except Exception as e:
+                log_msg(f"Error writing history: {e}", COLOR_RED)
+
+    def _node_id(self, db, address):
+        node_id = self.node_ids.get(address)
+
+        if node_id is None:
+            db.execute("INSERT OR IGNORE INTO nodes (address) VALUES (?)", (address,))
+            node_id = db.execute(
+                "SELECT id FROM nodes WHERE address = ?", (address,)
+            ).fetchone()[0]
+            self.node_ids[address] = node_id
+
+        return node_id
+
+    def _write(self, db, items):
+        rows = []
+        for address, timestamp, frequencies, noise, occupancy in items:
+            node_id = self._node_id(db, address)
+            if occupancy is None:
+                occupancy = [None] * len(frequencies)
+            else:
+                # NaN marks bins without an occupancy, stored as NULL
+                occupancy = [None if math.isnan(value) else value for value in occupancy.tolist()]
+            rows.extend(
+                zip(
+                    [node_id] * len(frequencies),
+                    np.round(frequencies * 1000).astype(np.int64).tolist(),
+                    [timestamp] * len(frequencies),
+                    noise.tolist(),
+                    occupancy,
+                )
+            )
+
+        db.executemany(
+            "INSERT OR REPLACE INTO samples_raw (node, freq_khz, ts, dbm, occupancy) VALUES (?, ?, ?, ?, ?)", rows
+        )
+
+        for name, (bucket_s, _) in HISTORY_ROLLUPS.items():
+            db.executemany(
+                f"INSERT INTO samples_{name} (node, freq_khz, ts, n, min_dbm, lin_sum, max_dbm, occ_sum, occ_n) "
+                "VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (node, freq_khz, ts) DO UPDATE SET "
+                "n = n + 1, min_dbm = min(min_dbm, excluded.min_dbm), "
+                "lin_sum = lin_sum + excluded.lin_sum, max_dbm = max(max_dbm, excluded.max_dbm), "
+                "occ_sum = occ_sum + excluded.occ_sum, occ_n = occ_n + excluded.occ_n",
+                [
+                    (
+                        node_id,
+                        freq_khz,
+                        ts - ts % bucket_s,
+                        dbm,
+                        math.pow(10, dbm / 10),
+                        dbm,
+                        occupancy or 0,
+                        0 if occupancy is None else 1,
+                    )
+                    for node_id, freq_khz, ts, dbm, occupancy in rows
+                ],
+            )
+
+    def _prune(self, db):
+        now = int(time.time())
+        db.execute("DELETE FROM samples_raw WHERE ts < ?", (now - HISTORY_RAW_RETENTION_S,))
+        for name, (_, retention_s) in HISTORY_ROLLUPS.items():
+            db.execute(f"DELETE FROM samples_{name} WHERE ts < ?", (now - retention_s,))
+
+    # Pick the finest resolution that keeps a query for this time range reasonably small
+    def resolution_for(self, start, end):
+        if end - start <= 3600:
+            return "raw"
+        if end - start <= 24 * 3600:
+            return "1m"
+        if end - start <= 14 * 24 * 3600:
+            return "15m"
+        return "1h"
+
+    # Returns a generator streaming the JSON response, rows are fetched in chunks
+    # so large ranges are never held in memory. Raises ValueError for bad queries.
+    def query(self, start, end, resolution, address=None, freq_min_mhz=None, freq_max_mhz=None):
+        if resolution != "raw" and resolution not in HISTORY_ROLLUPS:
+            raise ValueError(f"resolution must be one of raw, {', '.join(HISTORY_ROLLUPS)}")
+
+        if resolution == "raw":
+            columns = "s.dbm, s.dbm, s.dbm, 1, s.occupancy"
+        else:
+            columns = "s.min_dbm, s.lin_sum, s.max_dbm, s.n, s.occ_sum / nullif(s.occ_n, 0)"
+
+        where = ["s.ts >= ?", "s.ts <= ?"]
+        params = [int(start), int(end)]
+
+        if address is not None:
+            where.append("n.address = ?")
+            params.append(address)
+        if freq_min_mhz is not None:
+            where.append("s.freq_khz >= ?")
+            params.append(round(freq_min_mhz * 1000))
+        if freq_max_mhz is not None:
+            where.append("s.freq_khz <= ?")
+            params.append(round(freq_max_mhz * 1000))
+
+        sql = (
+            f"FROM samples_{resolution} s JOIN nodes n ON n.id = s.node "
+            f"WHERE {' AND '.join(where)}"
+        )
+
+        db = self._connect()
+
+        try:
+            count = db.execute(f"SELECT count(*) {sql}", params).fetchone()[0]
+            if count > HISTORY_MAX_ROWS:
+                raise ValueError(
+                    f"Query would return {count} rows, narrow it or use a coarser resolution"
+                )
+        except Exception:
+            db.close()
+            raise
+
+        def generate():
+            with closing(db):
+                cursor = db.execute(
+                    f"SELECT n.address, s.freq_khz, s.ts, {columns} {sql} "
+                    "ORDER BY s.node, s.freq_khz, s.ts",
+                    params,
+                )
 
+                yield json.dumps(
+                    {
+                        "resolution": resolution,
+                        "columns": ["address", "frequency", "timestamp", "min", "mean", "max", "occupancy"],
+                    }
+                )[:-1] + ', "rows": ['
+
+                first = True
+                while True:
+                    rows = cursor.fetchmany(1000)
+                    if len(rows) == 0:
+                        break
+
+                    chunk = ",".join(
+                        json.dumps(
+                            [
+                                address,
+                                freq_khz / 1000,
+                                ts,
+                                round(min_dbm, 3),
+                                round(10 * math.log10(lin_sum / n), 3) if resolution != "raw" else round(lin_sum, 3),
+                                round(max_dbm, 3),
+                                round(occupancy, 3) if occupancy is not None else None,
+                            ]
+                        )
+                        for address, freq_khz, ts, min_dbm, lin_sum, max_dbm, n, occupancy in rows
+                    )
+                    yield chunk if first else "," + chunk
+                    first = False
+
+                yield "]}"
+
+        return generate()
+
+
+def draw_log():
     win_height, win_width = log_win.getmaxyx()
     log_win.clear()
     log_win.box()
 
-    max_log_len = win_height - 2
-    if len(log) > max_log_len:
-        log = log[-max_log_len:]
-
     def addstr(y, x, text, *args):
         if 0 <= y < win_height - 1 and 0 <= x < win_width - 1:
             max_size = win_width - x - 1
@@ -53,7 +1203,10 @@ def draw_log():
 
     addstr(1, 2, "Logs / Messages")
 
-    for i, message in enumerate(log):
+    max_log_len = max(win_height - 3, 0)
+    messages = list(log)[-max_log_len:] if max_log_len > 0 else []
+
+    for i, message in enumerate(messages):
         if "color" in message:
             addstr(2 + i, 2, message["text"], curses.color_pair(message["color"]))
         else:
@@ -63,15 +1216,11 @@ def draw_log():
 
 
 def log_msg(message, color=None):
-    global log
-
     for line in message.splitlines():
         if color == None:
-            log.append({"text": line})
+            log.append({"seq": next(log_seq), "text": line})
         else:
-            log.append({"text": line, "color": color})
-
-    draw_log()
+            log.append({"seq": next(log_seq), "text": line, "color": color})
 
 
 def api_response(data, status_code=200):
@@ -80,7 +1229,7 @@ def api_response(data, status_code=200):
     response.headers["Content-Type"] = "application/json"  # Set MIME type
     response.headers["Access-Control-Allow-Origin"] = "*"  # Allow all origins
     response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
-    response.headers["Access-Control-Allow-Headers"] = "Content-Type"
+    response.headers["Access-Control-Allow-Headers"] = "Content-Type, If-None-Match"
     response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
     response.headers["Pragma"] = "no-cache"
     response.headers["Expires"] = "0"  # Immediate expiration
@@ -89,67 +1238,405 @@ def api_response(data, status_code=200):
 
 @app.route("/data")
 def data_endpoint():
-    with data_lock, config_lock:
-        with open(CONFIG_FILE, "r") as f:
-            config = json.load(f)
+    since = request.args.get("since", type=int)
+    wait_s = min(request.args.get("wait", 0, type=float), DATA_LONG_POLL_MAX_S)
+
+    with registry.lock:
+        # Long poll, hold the request until something changes, including the tasking
+        if since is not None and wait_s > 0 and registry.long_polls < DATA_LONG_POLL_MAX_WAITERS:
+            config_version = config_store.version
+            registry.long_polls += 1
+            try:
+                registry.changed.wait_for(
+                    lambda: registry.revision != since or config_store.version != config_version, wait_s
+                )
+            finally:
+                registry.long_polls -= 1
 
-        log_msg(f"Data fetched. Origin: {request.origin if request.origin != None else 'unknown'}")
+        config = config_store.snapshot()
+        etag = f"{config_store.version}-{registry.revision}"
 
-        return api_response(
-            {
+        if request.if_none_match.contains(etag):
+            body = None
+        else:
+            full, measurements, removed = registry.changes_since(since)
+            body = {
+                "revision": registry.revision,
                 "start_mhz": config["start_mhz"],
                 "end_mhz": config["end_mhz"],
                 "bandwidth_mhz": config["bandwidth_mhz"],
-                "sdrs": data,
+                "sdrs": measurements,
             }
+            if since is not None:
+                body["full"] = full
+                body["removed"] = removed
+
+    if body is None:
+        response = api_response("", 304)
+    else:
+        log_msg(f"Data fetched. Origin: {request.origin if request.origin != None else 'unknown'}")
+        response = api_response(body)
+
+    # Let browsers keep the response and revalidate it with If-None-Match
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["Access-Control-Expose-Headers"] = "ETag"
+    return response
+
+
+# Lets another server poll this one as a regional aggregator, getting every node it collects
+# in one request instead of polling each across a slow link. Pass since (the revision from the
+# last response) to only get nodes that have changed, and start_mhz/end_mhz to only get part
+# of the spectrum.
+@app.route("/aggregate", methods=["POST"])
+def aggregate_endpoint():
+    request_data = request.json or {}
+    since = request_data.get("since")
+    start_mhz = request_data.get("start_mhz", 0)
+    end_mhz = request_data.get("end_mhz", math.inf)
+
+    if since is not None and type(since) != int:
+        return api_response({"error": "Invalid since"}, 500)
+    if type(start_mhz) not in (int, float) or type(end_mhz) not in (int, float):
+        return api_response({"error": "Invalid start_mhz or end_mhz"}, 500)
+
+    with registry.lock:
+        full, sweeps, removed = registry.sweeps_since(since)
+        revision = registry.revision
+        sweep_s = [node["sweep_s"] for node in registry.nodes.values() if node["sweep_s"] is not None]
+
+    for sweep in sweeps:
+        in_range = (sweep["frequencies"] >= start_mhz) & (sweep["frequencies"] <= end_mhz)
+        sweep["frequencies"] = np.round(sweep["frequencies"][in_range], 6).tolist()
+        sweep["noise"] = np.round(sweep["noise"][in_range], 3).tolist()
+        if sweep["occupancy"] is not None:
+            sweep["occupancy"] = np.round(sweep["occupancy"][in_range], 3).tolist()
+
+    log_msg(f"Aggregate of {len(sweeps)} nodes fetched. Origin: {request.origin if request.origin != None else 'unknown'}")
+
+    return api_response(
+        {
+            "revision": revision,
+            "full": full,
+            "removed": removed,
+            # How often there is likely to be something new
+            "sweep_s": float(np.median(sweep_s)) if len(sweep_s) > 0 else None,
+            "sdrs": sweeps,
+        }
+    )
+
+
+# Seconds since each node's latest measurement was captured
+def node_staleness():
+    now = time.time()
+    with registry.lock:
+        return {
+            (address,): now - (node["capture_timestamp"] or node["last_success"] or math.nan)
+            for address, node in registry.nodes.items()
+        }
+
+
+def queue_depths():
+    depths = {}
+    if uploader is not None:
+        depths[("cloudrf",)] = uploader.queue.qsize()
+    if history is not None:
+        depths[("history",)] = history.queue.qsize()
+    return depths
+
+
+metrics.Gauge(
+    "dora_server_node_staleness_seconds", "Age of each node's latest measurement", ("node",), collect=node_staleness
+)
+metrics.Gauge("dora_server_queue_depth", "Items waiting in each background queue", ("queue",), collect=queue_depths)
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    response = make_response(metrics.render())
+    response.headers["Content-Type"] = metrics.CONTENT_TYPE
+    return response
+
+
+@app.route("/history")
+def history_endpoint():
+    address = request.args.get("address")
+    resolution = request.args.get("resolution")
+
+    try:
+        end = float(request.args.get("end", time.time()))
+        start = float(request.args.get("start", end - 3600))
+        freq_min_mhz = request.args.get("freq_min_mhz", type=float)
+        freq_max_mhz = request.args.get("freq_max_mhz", type=float)
+    except ValueError:
+        return api_response({"error": "start and end must be unix timestamps"}, 500)
+
+    if start > end:
+        return api_response({"error": "start must be before end"}, 500)
+
+    if resolution is None:
+        resolution = history.resolution_for(start, end)
+
+    try:
+        return api_response(
+            history.query(start, end, resolution, address, freq_min_mhz, freq_max_mhz)
         )
+    except ValueError as e:
+        return api_response({"error": f"{e}"}, 500)
+    except Exception as e:
+        log_msg(f"Error: {e}", COLOR_RED)
 
+        return api_response({"error": "Unable to query history"}, 500)
 
-@app.route("/node/add", methods=["POST"])
-def node_add_endpoint():
-    request_data = request.json
-    address = request_data.get("address").strip()
-    latitude = float(request_data.get("latitude"))
-    longitude = float(request_data.get("longitude"))
 
-    if type(address) != str:
-        return api_response({"error": "Invalid address must be string"}, 500)
-    if type(latitude) != float:
-        return api_response({"error": "Invalid latitude"}, 500)
-    if type(longitude) != float:
-        return api_response({"error": "Invalid longitude"}, 500)
+def parse_numbers(value, count, name, kind=float):
+    try:
+        numbers = [kind(number) for number in value.split(",")]
+    except ValueError:
+        numbers = []
+
+    if len(numbers) != count:
+        raise ValueError(f"{name} must be {count} comma separated numbers")
+    return numbers
+
+
+# Interpolates the noise of sweeps onto a rows x columns grid covering a latitude/longitude box
+# by inverse distance weighting. Returns (frequencies, latitudes, longitudes, noise) with noise
+# indexed [frequency, row, column].
+def interpolate_grid(sweeps, min_latitude, min_longitude, max_latitude, max_longitude, rows, columns):
+    latitudes = np.linspace(min_latitude, max_latitude, rows)
+    longitudes = np.linspace(min_longitude, max_longitude, columns)
+
+    if len(sweeps) == 0:
+        return np.zeros(0), latitudes, longitudes, np.zeros((0, rows, columns))
+
+    # Every frequency any node has, with NaN where a node doesn't have it
+    sweeps_khz = [np.round(sweep["frequencies"] * 1000).astype(np.int64) for sweep in sweeps]
+    frequencies_khz = np.unique(np.concatenate(sweeps_khz))
+    noise = np.full((len(sweeps), len(frequencies_khz)), np.nan)
+    for i, (sweep, sweep_khz) in enumerate(zip(sweeps, sweeps_khz)):
+        noise[i, np.searchsorted(frequencies_khz, sweep_khz)] = sweep["noise"]
+    has_noise = ~np.isnan(noise)
+
+    if rows * columns * max(len(frequencies_khz), len(sweeps)) > QUERY_MAX_GRID_VALUES:
+        raise ValueError("Grid too large, ask for fewer points, a smaller area or a narrower frequency range")
+
+    grid_latitudes, grid_longitudes = np.meshgrid(np.radians(latitudes), np.radians(longitudes), indexing="ij")
+    distance_m = haversine_m(
+        grid_latitudes.reshape(-1, 1),
+        grid_longitudes.reshape(-1, 1),
+        np.radians([sweep["latitude"] for sweep in sweeps]),
+        np.radians([sweep["longitude"] for sweep in sweeps]),
+    )
+    # Points on top of a node take its value
+    weights = np.maximum(distance_m, 1) ** -QUERY_IDW_POWER
+
+    grid_noise = (weights @ np.where(has_noise, noise, 0)) / (weights @ has_noise)
+    return frequencies_khz / 1000, latitudes, longitudes, grid_noise.T.reshape(-1, rows, columns)
 
+
+# Measurements of the nodes in an area, either bbox=min_lat,min_lon,max_lat,max_lon or within
+# radius_m of latitude/longitude, optionally only between freq_min_mhz and freq_max_mhz. With
+# grid=rows,columns the noise is also interpolated onto a grid covering the area.
+@app.route("/query")
+def query_endpoint():
     try:
-        with config_lock:
-            with open(CONFIG_FILE, "r") as f:
-                config = json.load(f)
+        freq_min_mhz = float(request.args.get("freq_min_mhz", -math.inf))
+        freq_max_mhz = float(request.args.get("freq_max_mhz", math.inf))
+
+        if "bbox" in request.args:
+            min_latitude, min_longitude, max_latitude, max_longitude = parse_numbers(request.args["bbox"], 4, "bbox")
+            centre = None
+        elif "radius_m" in request.args:
+            centre = (float(request.args["latitude"]), float(request.args["longitude"]))
+            radius_m = float(request.args["radius_m"])
+
+            # Box around the circle, then only keep what is inside it
+            latitude_deg = math.degrees(radius_m / EARTH_RADIUS_M)
+            longitude_deg = min(latitude_deg / max(math.cos(math.radians(centre[0])), 1e-6), 180)
+            min_latitude, max_latitude = max(centre[0] - latitude_deg, -90), min(centre[0] + latitude_deg, 90)
+            min_longitude, max_longitude = centre[1] - longitude_deg, centre[1] + longitude_deg
+        else:
+            raise ValueError("bbox or latitude, longitude and radius_m are required")
+
+        grid = parse_numbers(request.args["grid"], 2, "grid", int) if "grid" in request.args else None
+    except KeyError as e:
+        return api_response({"error": f"{e.args[0]} is required"}, 500)
+    except ValueError as e:
+        return api_response({"error": f"{e}"}, 500)
+
+    if min_latitude > max_latitude or min_longitude > max_longitude:
+        return api_response({"error": "bbox must be min_lat,min_lon,max_lat,max_lon"}, 500)
+    if grid is not None and (grid[0] < 2 or grid[1] < 2):
+        return api_response({"error": "grid must be at least 2,2"}, 500)
+    # Before anything is allocated for it, whether or not there are nodes in the area
+    if grid is not None and grid[0] * grid[1] > QUERY_MAX_GRID_VALUES:
+        return api_response({"error": f"grid must have at most {QUERY_MAX_GRID_VALUES} points"}, 500)
+
+    with registry.lock:
+        sweeps = registry.sweeps_within(min_latitude, min_longitude, max_latitude, max_longitude)
+
+    if centre is not None and len(sweeps) > 0:
+        distance_m = haversine_m(
+            math.radians(centre[0]),
+            math.radians(centre[1]),
+            np.radians([sweep["latitude"] for sweep in sweeps]),
+            np.radians([sweep["longitude"] for sweep in sweeps]),
+        )
+        sweeps = [
+            {**sweep, "distance_m": round(distance, 1)}
+            for sweep, distance in zip(sweeps, distance_m.tolist())
+            if distance <= radius_m
+        ]
+
+    for sweep in sweeps:
+        in_range = (sweep["frequencies"] >= freq_min_mhz) & (sweep["frequencies"] <= freq_max_mhz)
+        sweep["frequencies"] = sweep["frequencies"][in_range]
+        sweep["noise"] = sweep["noise"][in_range]
+        if sweep["occupancy"] is not None:
+            sweep["occupancy"] = sweep["occupancy"][in_range]
+    sweeps = [sweep for sweep in sweeps if len(sweep["frequencies"]) > 0]
+
+    body = {
+        "sdrs": [
+            {
+                **{key: value for key, value in sweep.items() if key not in ("frequencies", "noise", "occupancy")},
+                "data": measurement_data(sweep["frequencies"], sweep["noise"], sweep["occupancy"]),
+            }
+            for sweep in sweeps
+        ]
+    }
 
-            if "sdrs" not in config:
-                config["sdrs"] = []
+    if grid is not None:
+        try:
+            frequencies, latitudes, longitudes, noise = interpolate_grid(
+                sweeps, min_latitude, min_longitude, max_latitude, max_longitude, *grid
+            )
+        except ValueError as e:
+            return api_response({"error": f"{e}"}, 500)
+
+        body["grid"] = {
+            "latitudes": np.round(latitudes, 6).tolist(),
+            "longitudes": np.round(longitudes, 6).tolist(),
+            "frequencies": np.round(frequencies, 3).tolist(),
+            "noise": np.round(noise, 3).tolist(),
+        }
 
-            sdr_found = False
+    return api_response(body)
 
-            # If the SDR has already been added, update the position instead
-            for i, sdr in enumerate(config["sdrs"]):
-                if sdr["address"] == address:
-                    config["sdrs"][i]["latitude"] = latitude
-                    config["sdrs"][i]["longitude"] = longitude
-                    sdr_found = True
-                    break
 
-            if not sdr_found:
-                config["sdrs"].append(
-                    {
-                        "address": address,
-                        "latitude": latitude,
-                        "longitude": longitude,
-                    }
-                )
+# Returns a config "sdrs" entry from a node in a request or import, or raises ValueError
+def parse_sdr(sdr):
+    if type(sdr) != dict:
+        raise ValueError("Invalid node must be an object")
+
+    address = sdr.get("address")
+    if type(address) != str or len(address.strip()) == 0:
+        raise ValueError("Invalid address must be string")
+    address = address.strip()
+
+    try:
+        latitude = float(sdr.get("latitude"))
+        longitude = float(sdr.get("longitude"))
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid latitude or longitude for {address}")
+
+    if not -90 <= latitude <= 90:
+        raise ValueError(f"Invalid latitude for {address}")
+    if not -180 <= longitude <= 180:
+        raise ValueError(f"Invalid longitude for {address}")
+
+    # Another server.py to collect all of the nodes of, see /aggregate
+    aggregator = sdr.get("aggregator", False)
+    if type(aggregator) != bool:
+        raise ValueError(f"Invalid aggregator for {address}")
+
+    parsed = {"address": address, "latitude": latitude, "longitude": longitude}
+    if aggregator:
+        parsed["aggregator"] = True
+    return parsed
+
+
+# Returns (sdrs, addresses) to add and remove, or raises ValueError listing everything wrong
+def parse_node_changes(add, remove):
+    if type(add) != list or type(remove) != list:
+        raise ValueError("add and remove must be lists")
+
+    errors = []
+    sdrs = []
+    for i, sdr in enumerate(add):
+        try:
+            sdrs.append(parse_sdr(sdr))
+        except ValueError as e:
+            errors.append(f"add[{i}]: {e}")
+
+    for i, address in enumerate(remove):
+        if type(address) != str:
+            errors.append(f"remove[{i}]: Invalid address must be string")
 
-            with open(CONFIG_FILE, "w") as f:
-                f.write(json.dumps(config))
+    seen = set()
+    for address in [sdr["address"] for sdr in sdrs] + [a for a in remove if type(a) == str]:
+        if address in seen:
+            errors.append(f"{address} is listed more than once")
+        seen.add(address)
 
-        log_msg(f"Node {address} {'updated' if sdr_found else 'added'} by {request.origin if request.origin != None else 'unknown'}", COLOR_GREEN)
+    if len(errors) > 0:
+        more = f" and {len(errors) - 10} more" if len(errors) > 10 else ""
+        raise ValueError("; ".join(errors[:10]) + more)
+
+    return sdrs, remove
+
+
+# Adds or updates sdrs and removes addresses as a single config revision, so a whole batch is
+# written to disk once and collection only waits for the locks once. Nothing is changed if
+# any address to remove isn't known. Returns (added, updated, removed) counts.
+def apply_node_changes(sdrs, addresses):
+    with config_store.lock, registry.lock:
+        unknown = [address for address in addresses if address not in registry]
+        if len(unknown) > 0:
+            raise ValueError(f"Address not found: {', '.join(unknown)}")
+
+        config = config_store.copy()
+        config_sdrs = {sdr["address"]: sdr for sdr in config.get("sdrs", [])}
+        added = 0
+        updated = 0
+
+        for sdr in sdrs:
+            # If the SDR has already been added, update it instead
+            if registry.add(sdr["address"], sdr["latitude"], sdr["longitude"], sdr.get("aggregator", False), regroup=False):
+                updated += 1
+            else:
+                added += 1
+
+            entry = {**config_sdrs.get(sdr["address"], {}), **sdr}
+            if "aggregator" not in sdr:
+                entry.pop("aggregator", None)
+            config_sdrs[sdr["address"]] = entry
+
+        for address in addresses:
+            registry.remove(address, regroup=False)
+            config_sdrs.pop(address, None)
+
+        registry.regroup()
+
+        config["sdrs"] = list(config_sdrs.values())
+        config_store.commit(config)
+        wake_collect_loop()
+
+    return added, updated, len(addresses)
+
+
+@app.route("/node/add", methods=["POST"])
+def node_add_endpoint():
+    try:
+        sdr = parse_sdr(request.json)
+    except ValueError as e:
+        return api_response({"error": f"{e}"}, 500)
+
+    try:
+        _, updated, _ = apply_node_changes([sdr], [])
+
+        log_msg(f"Node {sdr['address']} {'updated' if updated else 'added'} by {request.origin if request.origin != None else 'unknown'}", COLOR_GREEN)
 
         return api_response("Node added successfully")
 
@@ -168,90 +1655,257 @@ def node_remove_endpoint():
     if type(address) != str:
         return api_response({"error": "Invalid address must be string"}, 500)
     try:
-        with config_lock, data_lock:
-            with open(CONFIG_FILE, "r") as f:
-                config = json.load(f)
+        apply_node_changes([], [address])
 
-            new_data = []
-            for d in data:
-                if d["address"] != address:
-                    new_data.append(d)
+        log_msg(f"Node {address} removed by {request.origin if request.origin != None else 'unknown'}", COLOR_GREEN)
 
-            new_sdrs = []
-            for sdr in config["sdrs"]:
-                if sdr["address"] != address:
-                    new_sdrs.append(sdr)
+        return api_response("Node removed successfully")
 
-            if len(new_data) == len(data) and len(new_sdrs) == len(config["sdrs"]):
-                return api_response({"error": "Address not found"}, 500)
+    except ValueError:
+        return api_response({"error": "Address not found"}, 500)
+    except Exception as e:
+        log_msg(f"Error: {e}", COLOR_RED)
 
-            config["sdrs"] = new_sdrs
+        return api_response({"error": f"Unable to remove node"}, 500)
 
-            data.clear()
-            data.extend(new_data)
 
-            with open(CONFIG_FILE, "w") as f:
-                f.write(json.dumps(config))
+# Adds, updates and removes many nodes at once. Every change is checked before any is made.
+#   {"add": [{"address": ..., "latitude": ..., "longitude": ...}, ...], "remove": [address, ...]}
+@app.route("/nodes/bulk", methods=["POST"])
+def nodes_bulk_endpoint():
+    request_data = request.json
 
-            log_msg(f"Node {address} removed by {request.origin if request.origin != None else 'unknown'}", COLOR_GREEN)
+    try:
+        sdrs, addresses = parse_node_changes(request_data.get("add", []), request_data.get("remove", []))
+        added, updated, removed = apply_node_changes(sdrs, addresses)
+    except ValueError as e:
+        return api_response({"error": f"{e}"}, 500)
+    except Exception as e:
+        log_msg(f"Error: {e}", COLOR_RED)
+
+        return api_response({"error": "Unable to update nodes"}, 500)
+
+    log_msg(
+        f"Nodes {added} added, {updated} updated, {removed} removed by {request.origin if request.origin != None else 'unknown'}",
+        COLOR_GREEN,
+    )
+
+    return api_response({"added": added, "updated": updated, "removed": removed})
+
+
+NODES_CSV_COLUMNS = ("address", "latitude", "longitude", "aggregator")
+
+
+# The configured nodes as JSON, or CSV with ?format=csv
+@app.route("/nodes", methods=["GET"])
+def nodes_export_endpoint():
+    sdrs = thaw(config_store.snapshot().get("sdrs", ()))
+
+    if request.args.get("format") != "csv":
+        return api_response({"sdrs": sdrs})
+
+    text = io.StringIO()
+    writer = csv.DictWriter(text, NODES_CSV_COLUMNS, extrasaction="ignore")
+    writer.writeheader()
+    for sdr in sdrs:
+        writer.writerow({**sdr, "aggregator": "true" if sdr.get("aggregator") else ""})
+
+    response = api_response(text.getvalue())
+    response.headers["Content-Type"] = "text/csv"
+    return response
 
-            return api_response("Node removed successfully")
 
+# Imports nodes exported by GET /nodes, as JSON or as CSV with a text/csv Content-Type.
+# Every node is added or updated, and with ?replace=true configured nodes missing from the
+# import are removed.
+@app.route("/nodes", methods=["POST"])
+def nodes_import_endpoint():
+    try:
+        if request.mimetype == "text/csv":
+            add = [
+                {**row, "aggregator": (row.get("aggregator") or "").strip().lower() in ("true", "1", "yes")}
+                for row in csv.DictReader(io.StringIO(request.get_data(as_text=True)))
+            ]
+        else:
+            add = request.get_json(silent=True)
+            if type(add) == dict:
+                add = add.get("sdrs")
+            if type(add) != list:
+                raise ValueError("Expected a list of nodes or an object with sdrs")
+
+        imported = set(sdr.get("address", "").strip() for sdr in add if type(sdr) == dict and type(sdr.get("address")) == str)
+        remove = []
+        if request.args.get("replace", "false").lower() in ("true", "1"):
+            remove = [sdr["address"] for sdr in config_store.snapshot().get("sdrs", ()) if sdr["address"] not in imported]
+
+        sdrs, addresses = parse_node_changes(add, remove)
+        added, updated, removed = apply_node_changes(sdrs, addresses)
+    except ValueError as e:
+        return api_response({"error": f"{e}"}, 500)
     except Exception as e:
         log_msg(f"Error: {e}", COLOR_RED)
 
-        return api_response({"error": f"Unable to remove node"}, 500)
+        return api_response({"error": "Unable to import nodes"}, 500)
 
+    log_msg(
+        f"Nodes imported, {added} added, {updated} updated, {removed} removed by {request.origin if request.origin != None else 'unknown'}",
+        COLOR_GREEN,
+    )
+
+    return api_response({"added": added, "updated": updated, "removed": removed})
 
-@app.route("/tasking", methods=["POST"])
-def tasking_endpoint():
-    request_data = request.json
 
+# Returns (start_mhz, end_mhz, bandwidth_mhz, profile, warning) from a /tasking or /plan request,
+# or raises ValueError. Profiles that can't sweep within the longest poll interval are adapted if
+# the request allows it, otherwise refused. Taskings that don't give a profile keep the one in
+# config and are used as they are, as they always have been, with a warning.
+def parse_tasking(request_data, config):
     start_mhz = request_data.get("start_mhz")
     end_mhz = request_data.get("end_mhz")
     bandwidth_mhz = request_data.get("bandwidth_mhz")
 
     # Frequencies and bandwidths must be ints. This is a wideband system
     if type(start_mhz) != int:
-        return api_response({"error": "Invalid start_mhz"}, 500)
+        raise ValueError("Invalid start_mhz")
     if type(end_mhz) != int:
-        return api_response({"error": "Invalid end_mhz"}, 500)
+        raise ValueError("Invalid end_mhz")
     if type(bandwidth_mhz) != int:
-        return api_response({"error": "Invalid bandwidth_mhz"}, 500)
+        raise ValueError("Invalid bandwidth_mhz")
 
     # Ensure your SDR can do the frequency you want :O
     if start_mhz < 1 or start_mhz > 2000:
-        return api_response({"error": "start_mhz must be between 1 and 2000 mhz"}, 500)
+        raise ValueError("start_mhz must be between 1 and 2000 mhz")
     if end_mhz < 1 or end_mhz > 2000:
-        return api_response({"error": "end_mhz must be between 1 and 2000 mhz"}, 500)
+        raise ValueError("end_mhz must be between 1 and 2000 mhz")
     if start_mhz > end_mhz:
-        return api_response({"error": "start_mhz must be below end_mhz"}, 500)
+        raise ValueError("start_mhz must be below end_mhz")
     if bandwidth_mhz < 1 or bandwidth_mhz > 20:
-        return api_response(
-            {"error": "bandwidth_mhz must be between 1 and 20 mhz"}, 500
-        )
+        raise ValueError("bandwidth_mhz must be between 1 and 20 mhz")
+
+    profile = validate_profile(request_data["profile"] if "profile" in request_data else thaw(config.get("profile")))
+    adapt = request_data.get("adapt", False)
+    fitted = fit_profile(start_mhz, end_mhz, bandwidth_mhz, profile, COLLECT_MAX_INTERVAL_S)
+
+    if fitted == profile or (fitted is not None and adapt):
+        return start_mhz, end_mhz, bandwidth_mhz, fitted, None
 
+    sweep_s = plan_sweep(start_mhz, end_mhz, bandwidth_mhz, profile)["sweep_s"]
+    if fitted is None:
+        warning = f"Tasking will take {sweep_s:.1f}s to sweep and can't be swept within {COLLECT_MAX_INTERVAL_S}s with any profile"
+    else:
+        warning = f"Tasking will take {sweep_s:.1f}s to sweep, more than {COLLECT_MAX_INTERVAL_S}s. Pass adapt to let the profile be adjusted"
+
+    if "profile" not in request_data and not adapt:
+        return start_mhz, end_mhz, bandwidth_mhz, profile, warning
+
+    raise ValueError(warning.replace("will take", "would take"))
+
+
+@app.route("/plan", methods=["POST"])
+def plan_endpoint():
+    try:
+        start_mhz, end_mhz, bandwidth_mhz, profile, warning = parse_tasking(request.json, config_store.snapshot())
+    except ValueError as e:
+        return api_response({"error": f"{e}"}, 500)
+
+    response = {**plan_sweep(start_mhz, end_mhz, bandwidth_mhz, profile), "profile": profile}
+    if warning is not None:
+        response["warning"] = warning
+
+    return api_response(response)
+
+
+@app.route("/tasking", methods=["POST"])
+def tasking_endpoint():
+    request_data = request.json
+
+    try:
+        start_mhz, end_mhz, bandwidth_mhz, profile, warning = parse_tasking(request_data, config_store.snapshot())
+    except ValueError as e:
+        return api_response({"error": f"{e}"}, 500)
+
+    # Optional, nodes within this many metres share the tasking. 0 turns sharding off
+    shard_radius_m = request_data.get("shard_radius_m")
+
+    if shard_radius_m is not None and (type(shard_radius_m) not in (int, float) or shard_radius_m < 0):
+        return api_response({"error": "Invalid shard_radius_m"}, 500)
+
+    # Optional, bins that move less than deadband_db aren't posted to CloudRF again until
+    # max_silence_s has passed. 0 posts every sweep
+    deadband_db = request_data.get("deadband_db")
+    max_silence_s = request_data.get("max_silence_s")
+
+    if deadband_db is not None and (type(deadband_db) not in (int, float) or deadband_db < 0 or deadband_db > 20):
+        return api_response({"error": "deadband_db must be between 0 and 20 dB"}, 500)
+    if max_silence_s is not None and (type(max_silence_s) not in (int, float) or max_silence_s < 1):
+        return api_response({"error": "max_silence_s must be 1 second or more"}, 500)
+
+    # Optional, how nodes work out each bin's noise, see capture_profile.py
     try:
-        with config_lock, data_lock:
-            data.clear()
+        measurement = validate_measurement(request_data["measurement"]) if "measurement" in request_data else None
+    except ValueError as e:
+        return api_response({"error": f"{e}"}, 500)
 
-            with open(CONFIG_FILE, "r") as f:
-                config = json.load(f)
+    try:
+        with config_store.lock, registry.lock:
+            config = config_store.copy()
+
+            current_measurement = validate_measurement(config.get("measurement"))
+            if measurement is None:
+                measurement = current_measurement
+
+            # Measurements taken a different way, or with different bins, aren't comparable with
+            # what comes next
+            registry.retask(
+                start_mhz,
+                end_mhz,
+                measurement != current_measurement
+                or bandwidth_mhz != config["bandwidth_mhz"]
+                or profile != validate_profile(thaw(config.get("profile"))),
+            )
 
             config["start_mhz"] = start_mhz
             config["end_mhz"] = end_mhz
             config["bandwidth_mhz"] = bandwidth_mhz
-
-            with open(CONFIG_FILE, "w") as f:
-                f.write(json.dumps(config))
+            config["profile"] = profile
+            config["measurement"] = measurement
+            if shard_radius_m is not None:
+                config["shard_radius_m"] = shard_radius_m
+                registry.set_shard_radius(shard_radius_m)
+            if deadband_db is not None:
+                config["deadband_db"] = deadband_db
+            if max_silence_s is not None:
+                config["max_silence_s"] = max_silence_s
+
+            config_store.commit(config)
+            wake_collect_loop()
+            # /data long polls and the API workers show the tasking too
+            registry.changed.notify_all()
 
             log_msg(f"Tasking updated:", COLOR_GREEN)
             log_msg(f"      start_mhz    : {start_mhz}", COLOR_GREEN)
             log_msg(f"      end_mhz      : {start_mhz}", COLOR_GREEN)
             log_msg(f"      bandwidth_mhz: {bandwidth_mhz}", COLOR_GREEN)
+            log_msg(f"      profile      : {profile}", COLOR_GREEN)
+            log_msg(f"      measurement  : {measurement}", COLOR_GREEN)
+            if shard_radius_m is not None:
+                log_msg(f"      shard_radius_m: {shard_radius_m}", COLOR_GREEN)
+            if deadband_db is not None:
+                log_msg(f"      deadband_db  : {deadband_db}", COLOR_GREEN)
+            if max_silence_s is not None:
+                log_msg(f"      max_silence_s: {max_silence_s}", COLOR_GREEN)
             log_msg(f"      origin       : {request.origin if request.origin != None else 'unknown'}", COLOR_GREEN)
 
-            return api_response("Tasking updated successfully")
+            response = {
+                "message": "Tasking updated successfully",
+                "profile": profile,
+                "plan": plan_sweep(start_mhz, end_mhz, bandwidth_mhz, profile),
+            }
+            if warning is not None:
+                log_msg(f"Warning: {warning}", COLOR_YELLOW)
+                response["warning"] = warning
+
+            return api_response(response)
 
     except Exception as e:
         log_msg(f"Error: {e}", COLOR_RED)
@@ -267,9 +1921,7 @@ def draw_output():
 
     data_col_size = 8
 
-    with config_lock:
-        with open(CONFIG_FILE, "r") as f:
-            config = json.load(f)
+    config = config_store.snapshot()
 
     thermal_noise = -173.8 + 10 * math.log10(config["bandwidth_mhz"] * 1e6)
 
@@ -287,51 +1939,52 @@ def draw_output():
         curses.color_pair(COLOR_GREEN),
     )
 
-    with data_lock:
-
-        # Draw address column
-        address_header = "SDR"
-        addstr(3, 2, address_header, curses.A_BOLD)
-        largest_address_len = len(address_header)
+    with registry.lock:
+        data = registry.measurements()
+
+    # Draw address column
+    address_header = "SDR"
+    addstr(3, 2, address_header, curses.A_BOLD)
+    largest_address_len = len(address_header)
+    for j, sdr in enumerate(data):
+        addstr(4 + j, 2, sdr["address"], curses.A_BOLD)
+        largest_address_len = max(largest_address_len, len(sdr["address"]))
+
+    if len(data) > 0:
+
+        # Draw freqeuncies
+        for i, sdr_data in enumerate(data[0]["data"]):
+            addstr(
+                3,
+                2 + largest_address_len + (i * data_col_size),
+                f"{sdr_data['frequency']:{data_col_size}.1f}",
+                curses.A_BOLD,
+            )
+
+        # Draw noise values
         for j, sdr in enumerate(data):
-            addstr(4 + j, 2, sdr["address"], curses.A_BOLD)
-            largest_address_len = max(largest_address_len, len(sdr["address"]))
+            for i, sdr_data in enumerate(sdr["data"]):
 
-        if len(data) > 0:
+                noise = int(sdr_data["noise"])
+
+                colorpair = COLOR_GREEN
+                if noise > thermal_noise + 10:
+                    colorpair = COLOR_YELLOW
+                if noise > thermal_noise + 20:
+                    colorpair = COLOR_RED
 
-            # Draw freqeuncies
-            for i, sdr_data in enumerate(data[0]["data"]):
                 addstr(
-                    3,
+                    4 + j,
                     2 + largest_address_len + (i * data_col_size),
-                    f"{sdr_data['frequency']:{data_col_size}.1f}",
-                    curses.A_BOLD,
+                    f"{noise:{data_col_size}.0f}",
+                    curses.color_pair(colorpair),
                 )
 
-            # Draw noise values
-            for j, sdr in enumerate(data):
-                for i, sdr_data in enumerate(sdr["data"]):
-
-                    noise = int(sdr_data["noise"])
-
-                    colorpair = COLOR_GREEN
-                    if noise > thermal_noise + 10:
-                        colorpair = COLOR_YELLOW
-                    if noise > thermal_noise + 20:
-                        colorpair = COLOR_RED
-
-                    addstr(
-                        4 + j,
-                        2 + largest_address_len + (i * data_col_size),
-                        f"{noise:{data_col_size}.0f}",
-                        curses.color_pair(colorpair),
-                    )
-
     win.refresh()
 
 
-def serve_thread_fn():
-    serve(app, host="0.0.0.0", port=8080)
+def serve_thread_fn(listen):
+    serve(app, listen=listen, threads=SERVE_THREADS)
 
 
 def curses_main(stdscr):
@@ -377,174 +2030,1056 @@ def curses_main(stdscr):
 
     create_subwins()
 
+    # curses is only ever touched from this thread. getch() doubles as the frame timer.
+    stdscr.timeout(1000 // RENDER_FPS)
+    drawn_log_seq = 0
+    drawn_output = None
+
     while True:
         key = stdscr.getch()
         if key == ord("q"):
             break
 
+        try:
+            if len(log) > 0 and log[-1]["seq"] != drawn_log_seq:
+                drawn_log_seq = log[-1]["seq"]
+                draw_log()
+
+            if drawn_output != (config_store.version, registry.revision):
+                drawn_output = (config_store.version, registry.revision)
+                draw_output()
+
+        except curses.error:
+            pass
+
     curses.nocbreak()
     stdscr.keypad(False)
     stdscr.refresh()
     curses.echo()
 
 
-def collect(sdr, settings):
+# Without a terminal (e.g. under systemd) log lines are printed instead of drawn
+def headless_main():
+    printed_log_seq = 0
+
+    while True:
+        for message in list(log):
+            if message["seq"] > printed_log_seq:
+                print(message["text"])
+                printed_log_seq = message["seq"]
+
+        sys.stdout.flush()
+        time.sleep(1 / RENDER_FPS)
+
+
+def create_collect_session():
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=COLLECT_MAX_CONCURRENT,
+            keepalive_timeout=COLLECT_KEEPALIVE_S,
+            ssl=None if REQUEST_VERIFY_SSL else False,
+        ),
+        timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_S),
+    )
+
+
+# Both return (frequencies, noise, occupancy) arrays, occupancy is None unless the node sent it
+def decode_power_binary(body):
+    magic, first_freq_mhz, step_mhz, count = POWER_HEADER.unpack_from(body)
+    if magic not in (POWER_MAGIC, POWER_OCCUPANCY_MAGIC):
+        raise RuntimeError("Unrecognised power response")
+
+    noise = np.frombuffer(body, dtype="<f4", count=count, offset=POWER_HEADER.size)
+    occupancy = None
+    if magic == POWER_OCCUPANCY_MAGIC:
+        occupancy = np.frombuffer(body, dtype="<f4", count=count, offset=POWER_HEADER.size + 4 * count)
+        occupancy = occupancy.astype(np.float64)
+
+    return first_freq_mhz + np.arange(count) * step_mhz, noise.astype(np.float64), occupancy
+
+
+def decode_power_json(response_json):
+    occupancy = None
+    if any("occupancy" in d for d in response_json):
+        occupancy = np.array([d.get("occupancy", math.nan) for d in response_json], dtype=np.float64)
+
+    return (
+        np.array([d["freq_mhz"] for d in response_json], dtype=np.float64),
+        np.array([d["power_dbm"] for d in response_json], dtype=np.float64),
+        occupancy,
+    )
+
+
+def header_float(headers, name):
     try:
-        response = requests.post(
+        return float(headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+# result is (frequencies, noise, occupancy, capture timestamp, sweep duration, ETag). Nodes that
+# predate the capture headers give None for the last three. If the node answers that nothing
+# has changed since etag, frequencies, noise and occupancy are None.
+async def collect(session, sdr, settings, timeout_s=REQUEST_TIMEOUT_S, etag=None):
+    # Older nodes ignore this and answer with JSON
+    headers = {"Accept": f"{POWER_MIME_TYPE}, application/json;q=0.5"}
+    if etag is not None:
+        headers["If-None-Match"] = f'"{etag}"'
+
+    try:
+        async with session.post(
             f"{sdr['address']}/power",
             json=settings,
-            timeout=REQUEST_TIMEOUT_S,
-            verify=REQUEST_VERIFY_SSL,
-        )
-        response_json = response.json()
-        if "error" in response_json:
-            raise RuntimeError(response_json["error"])
-        response.raise_for_status()
-        return False, sdr, response_json
+            timeout=aiohttp.ClientTimeout(total=timeout_s),
+            headers=headers,
+        ) as response:
+            if response.status == 304:
+                frequencies, noise, occupancy = None, None, None
+            elif response.content_type == POWER_MIME_TYPE:
+                response.raise_for_status()
+                frequencies, noise, occupancy = decode_power_binary(await response.read())
+            else:
+                response_json = await response.json(content_type=None)
+                if "error" in response_json:
+                    raise RuntimeError(response_json["error"])
+                response.raise_for_status()
+                frequencies, noise, occupancy = decode_power_json(response_json)
+
+            return False, sdr, (
+                frequencies,
+                noise,
+                occupancy,
+                header_float(response.headers, "X-Capture-Timestamp"),
+                header_float(response.headers, "X-Sweep-Duration"),
+                response.headers.get("ETag", "").strip('"') or None,
+            )
 
     except Exception as e:
+        if isinstance(e, asyncio.TimeoutError):
+            e = RuntimeError(f"Timed out after {timeout_s:.0f}s")
         return True, sdr, e
 
 
-def collect_thread_fn():
-    while True:
+# result is the body of the aggregator's /aggregate response
+async def collect_aggregate(session, sdr, settings, since=None):
+    try:
+        async with session.post(
+            f"{sdr['address']}/aggregate",
+            json={**settings, "since": since},
+            timeout=aiohttp.ClientTimeout(total=AGGREGATE_TIMEOUT_S),
+        ) as response:
+            response_json = await response.json(content_type=None)
+            if "error" in response_json:
+                raise RuntimeError(response_json["error"])
+            response.raise_for_status()
+
+            return False, sdr, response_json
 
-        with config_lock:
-            with open(CONFIG_FILE, "r") as f:
-                config = json.load(f)
+    except Exception as e:
+        if isinstance(e, asyncio.TimeoutError):
+            e = RuntimeError(f"Timed out after {AGGREGATE_TIMEOUT_S:.0f}s")
+        return True, sdr, e
 
-        settings = {
-            "start_mhz": config["start_mhz"],
-            "end_mhz": config["end_mhz"],
-            "bandwidth_mhz": config["bandwidth_mhz"],
-        }
 
-        cloudrf_noise_data = []
+# Returns a mask of the frequencies that need posting to CloudRF: those that have moved more
+# than deadband_db since they were last posted or weren't posted in the last max_silence_s.
+# Must be called with registry.lock held.
+def changed_since_posted(node, frequencies, noise, now, deadband_db, max_silence_s):
+    frequencies_khz = np.round(frequencies * 1000).astype(np.int64)
+    posted_khz, posted_noise, posted_at = node["posted"] or (np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0))
+
+    if len(posted_khz) == 0:
+        changed = np.ones(len(frequencies), dtype=bool)
+    else:
+        index = np.minimum(np.searchsorted(posted_khz, frequencies_khz), len(posted_khz) - 1)
+        changed = (
+            (posted_khz[index] != frequencies_khz)
+            | (np.abs(noise - posted_noise[index]) > deadband_db)
+            | (now - posted_at[index] >= max_silence_s)
+        )
 
-        with ThreadPoolExecutor() as executor:
+    # Remember what is about to be posted, along with anything posted before at other frequencies
+    keep = ~np.isin(posted_khz, frequencies_khz[changed])
+    posted_khz = np.concatenate([posted_khz[keep], frequencies_khz[changed]])
+    posted_noise = np.concatenate([posted_noise[keep], noise[changed]])
+    posted_at = np.concatenate([posted_at[keep], np.full(np.count_nonzero(changed), now)])
 
-            futures = []
-            if "sdrs" in config:
-                for sdr in config["sdrs"]:
-                    futures.append(executor.submit(collect, sdr, settings))
+    order = np.argsort(posted_khz)
+    node["posted"] = (posted_khz[order], posted_noise[order], posted_at[order])
 
-            for future in as_completed(futures):
-                err, sdr, result = future.result()
+    return changed
 
-                if err:
-                    log_msg(
-                        f"Error collection data from {sdr['address']}: {result}", COLOR_RED
-                    )
-                    continue
 
-                # Re-fetch config to ensure we don't add data collected from nodes that have just been removed
-                with config_lock, data_lock:
-                    with open(CONFIG_FILE, "r") as f:
-                        config = json.load(f)
+def store_result(sdr, result, cloudrf_noise_data):
+    frequencies, noise, occupancy, capture_timestamp, _, etag = result
 
-                    found_in_config = False
+    with registry.lock:
+        # Re-fetch config to ensure we don't add data collected from nodes that have just been removed
+        config = config_store.snapshot()
 
-                    for config_sdr in config["sdrs"]:
-                        if config_sdr["address"] == sdr["address"]:
-                            found_in_config = True
+        node = registry.get(sdr["address"])
+        if node is None:
+            return False
 
-                    if not found_in_config:
-                        continue
+        # Polled again before the node finished another sweep, or it had nothing new to say
+        if frequencies is None or (capture_timestamp is not None and capture_timestamp == node["capture_timestamp"]):
+            node["etag"] = etag
+            registry.record_alive(sdr["address"])
+            return False
 
-                    sdr_data = []
-                    for d in result:
-                        if (
-                            d["freq_mhz"] < config["start_mhz"]
-                            or d["freq_mhz"] > config["end_mhz"]
-                        ):
-                            continue
-
-                        cloudrf_noise_data.append(
-                            {
-                                "frequency": d["freq_mhz"],
-                                "latitude": sdr["latitude"],
-                                "longitude": sdr["longitude"],
-                                "noise": min(
-                                    max(d["power_dbm"], CLOUDRF_NOISE_MIN),
-                                    CLOUDRF_NOISE_MAX,
-                                ),
-                            }
-                        )
-                        sdr_data.append(
-                            {"frequency": d["freq_mhz"], "noise": d["power_dbm"]}
-                        )
+        # Sharded nodes only keep their own part of the tasking
+        in_tasking = (
+            (frequencies >= max(config["start_mhz"], sdr.get("start_mhz", config["start_mhz"])))
+            & (frequencies <= min(config["end_mhz"], sdr.get("end_mhz", config["end_mhz"])))
+            & ~np.isnan(noise)
+        )
+        frequencies = frequencies[in_tasking]
+        noise = noise[in_tasking]
+        if occupancy is not None:
+            occupancy = occupancy[in_tasking]
+        node["etag"] = etag
+
+        # Only post bins that moved by more than the deadband, or haven't been posted for a while
+        posted = np.ones(len(frequencies), dtype=bool)
+        if config.get("deadband_db", 0) > 0:
+            posted = changed_since_posted(
+                node, frequencies, noise, time.time(), config["deadband_db"], config.get("max_silence_s", 3600)
+            )
+
+        cloudrf_noise_data.extend(
+            {
+                "frequency": frequency,
+                "latitude": node["latitude"],
+                "longitude": node["longitude"],
+                "noise": clipped_noise,
+            }
+            for frequency, clipped_noise in zip(
+                frequencies[posted].tolist(),
+                np.round(np.clip(noise[posted], CLOUDRF_NOISE_MIN, CLOUDRF_NOISE_MAX), 3).tolist(),
+            )
+        )
 
-                    existing_data_found = False
-
-                    for i, existing_data in enumerate(data):
-                        if existing_data["address"] == sdr["address"]:
-                            data[i]["latitude"] = sdr["latitude"]
-                            data[i]["longitude"] = sdr["longitude"]
-                            data[i]["data"] = sdr_data
-                            existing_data_found = True
-                            break
-
-                    if not existing_data_found:
-                        data.append(
-                            {
-                                "address": sdr["address"],
-                                "latitude": sdr["latitude"],
-                                "longitude": sdr["longitude"],
-                                "data": sdr_data,
-                            }
-                        )
+        registry.record_success(sdr["address"], frequencies, noise, capture_timestamp, occupancy)
 
-                    log_msg(f"Succesfully collected data from {sdr['address']}")
+    history.submit(
+        sdr["address"],
+        capture_timestamp if capture_timestamp is not None else time.time(),
+        frequencies,
+        noise,
+        occupancy,
+    )
 
-        with config_lock:
-            with open(CONFIG_FILE, "r") as f:
-                config = json.load(f)
+    return True
+
+
+# Stores every node in an aggregator's response as if it had been polled directly, under
+# "<address> via <aggregator address>". Returns how many had new measurements.
+def store_aggregate(sdr, body, cloudrf_noise_data):
+    with registry.lock:
+        aggregator = registry.get(sdr["address"])
+        if aggregator is None:
+            return 0
+
+        registry.record_alive(sdr["address"])
+        aggregator["etag"] = body["revision"]
+
+        remotes = []
+        for remote in body["sdrs"]:
+            address = f"{remote['address']} via {sdr['address']}"
+            node = registry.get(address)
+            if node is None or (node["latitude"], node["longitude"]) != (remote["latitude"], remote["longitude"]):
+                registry.add(address, remote["latitude"], remote["longitude"], via=sdr["address"])
+            remotes.append((address, remote))
+
+        if body["full"]:
+            reported = set(address for address, _ in remotes)
+            removed = [
+                address
+                for address, node in registry.nodes.items()
+                if node["via"] == sdr["address"] and address not in reported
+            ]
+        else:
+            removed = [f"{address} via {sdr['address']}" for address in body["removed"]]
+
+        for address in removed:
+            registry.remove(address)
+
+    stored = 0
+    for address, remote in remotes:
+        result = (
+            np.array(remote["frequencies"], dtype=np.float64),
+            np.array(remote["noise"], dtype=np.float64),
+            # Aggregators that predate occupancy don't send it
+            np.array(remote["occupancy"], dtype=np.float64) if remote.get("occupancy") is not None else None,
+            remote["capture_timestamp"],
+            None,
+            None,
+        )
+        if store_result({**sdr, "address": address}, result, cloudrf_noise_data):
+            stored += 1
+
+    return stored
+
+
+# Polls nodes from worker processes so decoding their responses doesn't compete for the GIL
+# with the API. Each node is always polled by the same worker so it keeps its connection.
+# Sweeps come back in the worker's shared memory matrix, in the slot reserved for the request,
+# with only a small message on the results queue. collect() hands them on as views of the slot,
+# which stays reserved until the lease returned with them is given back to release().
+class CollectorPool:
+    def __init__(self, processes):
+        self.context = multiprocessing.get_context("spawn")
+        self.results = self.context.Queue()
+        self.workers = []
+        self.pending = {}
+        self.request_ids = count()
+        self.loop = None
+
+        for _ in range(processes):
+            shm = shared_memory.SharedMemory(create=True, size=3 * COLLECT_MAX_CONCURRENT * COLLECTOR_SHM_MAX_BINS * 8)
+            self.workers.append({"shm": shm, "matrix": collector_matrix(shm)})
+            self._spawn(self.workers[-1])
+
+    # Gives worker a new process, which reuses its shared memory
+    def _spawn(self, worker):
+        worker["requests"] = self.context.Queue()
+        worker["process"] = self.context.Process(
+            target=collector_process_main, args=(worker["shm"].name, worker["requests"], self.results), daemon=True
+        )
+        # Slots are only freed when the worker answers, so requests it never answers can use them
+        # all up even though the semaphore in collect_loop has been released
+        worker["free_slots"] = list(range(COLLECT_MAX_CONCURRENT))
+
+    def start(self):
+        for worker in self.workers:
+            worker["process"].start()
+
+    # Fails everything sent to a worker whose process has died and starts another
+    def _restart(self, worker):
+        log_msg(
+            f"Collector process {worker['process'].pid} exited with code {worker['process'].exitcode}, restarting it",
+            COLOR_RED,
+        )
 
-        if (
-            "cloudrf_api" in config
-            and "cloudrf_api_key" in config
-            and len(cloudrf_noise_data) > 0
-        ):
-            try:
-                response = requests.post(
-                    f"{config['cloudrf_api']}/noise/create",
-                    headers={
-                        "key": config["cloudrf_api_key"],
-                        "Accept": "application/json",
-                    },
-                    json=cloudrf_noise_data,
-                    timeout=REQUEST_TIMEOUT_S,
-                    verify=REQUEST_VERIFY_SSL,
-                )
-                response_json = response.json()
-                if "error" in response_json:
-                    raise RuntimeError(response_json["error"])
-                response.raise_for_status()
+        for request_id, (future, other, _, sdr) in list(self.pending.items()):
+            if other is worker:
+                del self.pending[request_id]
+                if not future.done():
+                    future.set_result((True, sdr, RuntimeError("Collector process exited"), None))
+
+        self._spawn(worker)
+        worker["process"].start()
+
+    def close(self):
+        for worker in self.workers:
+            worker["requests"].put(None)
+            worker["process"].join(timeout=REQUEST_TIMEOUT_S)
+            worker["shm"].close()
+            worker["shm"].unlink()
+
+    # Must be called from collect_loop, which gets the results
+    async def collect(self, sdr, settings, timeout_s, etag, aggregator):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+            threading.Thread(target=self._read_results, daemon=True).start()
+
+        worker = self.workers[zlib.crc32(sdr["address"].encode()) % len(self.workers)]
+        if not worker["process"].is_alive():
+            self._restart(worker)
+        if len(worker["free_slots"]) == 0:
+            return True, sdr, RuntimeError(f"Collector process {worker['process'].pid} has no free slots"), None
+
+        slot = worker["free_slots"].pop()
+        request_id = next(self.request_ids)
+        future = self.loop.create_future()
+        self.pending[request_id] = (future, worker, slot, sdr)
+
+        worker["requests"].put((request_id, slot, sdr, settings, timeout_s, etag, aggregator))
 
-                log_msg(
-                    f"Succesfully posted {len(cloudrf_noise_data)} noise measurements to {config['cloudrf_api']}"
+        try:
+            # Allow for a worker that has died
+            return await asyncio.wait_for(
+                asyncio.shield(future), (AGGREGATE_TIMEOUT_S if aggregator else timeout_s) + REQUEST_TIMEOUT_S
+            )
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # Nobody is left to take the result, so _resolve frees the slot if the worker ever answers.
+            # If it answered just now, the lease came with the result.
+            if not future.cancel():
+                self.release(future.result()[3])
+            if isinstance(e, asyncio.CancelledError):
+                raise
+
+            if not worker["process"].is_alive():
+                self._restart(worker)
+            return True, sdr, RuntimeError(f"No answer from collector process {worker['process'].pid}"), None
+
+    def release(self, lease):
+        if lease is None:
+            return
+
+        worker, process, slot = lease
+        # A restarted worker starts with every slot free
+        if worker["process"] is process:
+            worker["free_slots"].append(slot)
+
+    def _read_results(self):
+        while True:
+            message = self.results.get()
+            self.loop.call_soon_threadsafe(self._resolve, *message)
+
+    def _resolve(self, request_id, err, in_shm, result):
+        # Requests to a worker that has been restarted have already failed
+        if request_id not in self.pending:
+            return
+
+        future, worker, slot, sdr = self.pending.pop(request_id)
+        lease = (worker, worker["process"], slot)
+
+        # Timed out or cancelled by a retask
+        if future.done():
+            self.release(lease)
+            return
+
+        if err:
+            result = RuntimeError(result)
+        elif in_shm:
+            bins, has_occupancy, *headers = result
+            matrix = worker["matrix"]
+            occupancy = matrix[2, slot, :bins] if has_occupancy else None
+            result = (matrix[0, slot, :bins], matrix[1, slot, :bins], occupancy, *headers)
+
+        if err or not in_shm:
+            self.release(lease)
+            lease = None
+
+        future.set_result((err, sdr, result, lease))
+
+
+def collector_matrix(shm):
+    return np.ndarray((3, COLLECT_MAX_CONCURRENT, COLLECTOR_SHM_MAX_BINS), dtype=np.float64, buffer=shm.buf)
+
+
+def collector_process_main(shm_name, requests_queue, results_queue):
+    # The server handles Ctrl+C and stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(collector_process_loop(shm_name, requests_queue, results_queue))
+
+
+async def collector_process_loop(shm_name, requests_queue, results_queue):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    matrix = collector_matrix(shm)
+    session = create_collect_session()
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    async def handle(request_id, slot, sdr, settings, timeout_s, etag, aggregator):
+        if aggregator:
+            err, _, result = await collect_aggregate(session, sdr, settings, etag)
+        else:
+            err, _, result = await collect(session, sdr, settings, timeout_s, etag)
+
+        if err:
+            results_queue.put((request_id, True, False, f"{result}"))
+        elif aggregator or result[0] is None or len(result[0]) > COLLECTOR_SHM_MAX_BINS:
+            results_queue.put((request_id, False, False, result))
+        else:
+            frequencies, noise, occupancy, *headers = result
+            matrix[0, slot, : len(frequencies)] = frequencies
+            matrix[1, slot, : len(noise)] = noise
+            if occupancy is not None:
+                matrix[2, slot, : len(occupancy)] = occupancy
+            results_queue.put((request_id, False, True, (len(frequencies), occupancy is not None, *headers)))
+
+    while True:
+        request = await loop.run_in_executor(None, requests_queue.get)
+        if request is None:
+            break
+
+        task = asyncio.create_task(handle(*request))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    await session.close()
+    del matrix
+    shm.close()
+
+
+# Publishes what /data serves to shared memory for API worker processes: a header, a JSON index
+# of every node and the removed ones, then every node's bins back to back in a (frequencies,
+# noise, occupancy) matrix. Readers retry if the sequence number was odd or changed meanwhile.
+# When the nodes outgrow it, it is replaced by a bigger one and the old one points readers at it.
+class DataPublisher:
+    def __init__(self):
+        # Replaced segments, kept until close as workers may not have followed them yet
+        self.retired = []
+        self._create(API_SHM_INDEX_BYTES, API_SHM_BINS)
+        self.published = None
+        self.processes = []
+
+    def _create(self, index_bytes, bins):
+        self.shm = shared_memory.SharedMemory(create=True, size=API_SHM_HEADER_VALUES * 8 + index_bytes + 3 * bins * 8)
+        np.ndarray(API_SHM_HEADER_VALUES, dtype=np.int64, buffer=self.shm.buf)[5:] = (index_bytes, bins)
+        self.header, self.index, self.values = api_shm_views(self.shm)
+
+    def start(self, processes, listen):
+        threading.Thread(target=self._run, daemon=True).start()
+
+        context = multiprocessing.get_context("spawn")
+        for _ in range(processes):
+            process = context.Process(target=api_process_main, args=(self.shm.name, listen), daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def close(self):
+        for process in self.processes:
+            process.terminate()
+            process.join(timeout=REQUEST_TIMEOUT_S)
+        self.header = self.index = self.values = None
+        for shm in self.retired + [self.shm]:
+            shm.close()
+            shm.unlink()
+
+    def _run(self):
+        while True:
+            with registry.lock:
+                # Config changes such as a new tasking don't always touch the registry
+                registry.changed.wait_for(
+                    lambda: (config_store.version, registry.revision) != self.published, 1
                 )
+                self.published = (config_store.version, registry.revision)
+                config = config_store.snapshot()
+                sweeps = registry.stitched_sweeps()
+                removed = dict(registry.removed)
+                full_revision = registry.full_revision
+
+            try:
+                self._write(*self.published, config, sweeps, removed, full_revision)
             except Exception as e:
+                log_msg(f"Error publishing data to API workers: {e}", COLOR_RED)
+
+            time.sleep(API_PUBLISH_INTERVAL_S)
+
+    def _write(self, config_version, revision, config, sweeps, removed, full_revision):
+        entries = []
+        offset = 0
+        for sweep in sweeps:
+            bins = len(sweep["frequencies"])
+            entries.append(
+                {
+                    **{key: value for key, value in sweep.items() if key not in ("frequencies", "noise", "occupancy")},
+                    "offset": offset,
+                    "bins": bins,
+                    "occupancy": sweep["occupancy"] is not None,
+                }
+            )
+            offset += bins
+
+        index = json.dumps(
+            {
+                "full_revision": full_revision,
+                "start_mhz": config["start_mhz"],
+                "end_mhz": config["end_mhz"],
+                "bandwidth_mhz": config["bandwidth_mhz"],
+                "removed": removed,
+                "sdrs": entries,
+            }
+        ).encode()
+
+        replaced = None
+        if len(index) > len(self.index) or offset > self.values.shape[1]:
+            replaced = self.shm, self.header, self.index
+            self._create(max(2 * len(self.index), len(index)), max(2 * self.values.shape[1], offset))
+            log_msg(
+                f"Data for API workers outgrew shared memory, now {len(self.index)} bytes of index and {self.values.shape[1]} bins",
+                COLOR_YELLOW,
+            )
+
+        self.header[0] += 1
+        for entry, sweep in zip(entries, sweeps):
+            bins = slice(entry["offset"], entry["offset"] + entry["bins"])
+            self.values[0, bins] = sweep["frequencies"]
+            self.values[1, bins] = sweep["noise"]
+            self.values[2, bins] = sweep["occupancy"] if sweep["occupancy"] is not None else np.nan
+        self.index[: len(index)] = np.frombuffer(index, dtype=np.uint8)
+        self.header[1:4] = (len(index), revision, config_version)
+        self.header[0] += 1
+
+        # Only once the new one has data, point readers of the old one at it
+        if replaced is not None:
+            shm, header, old_index = replaced
+            name = self.shm.name.encode()
+            header[0] += 1
+            old_index[: len(name)] = np.frombuffer(name, dtype=np.uint8)
+            header[1] = len(name)
+            header[4] = 1
+            header[0] += 1
+            self.retired.append(shm)
+
+
+# Returns (header, index, values) views of DataPublisher's shared memory, sized by the header
+def api_shm_views(shm):
+    header = np.ndarray(API_SHM_HEADER_VALUES, dtype=np.int64, buffer=shm.buf)
+    index_bytes, bins = (int(value) for value in header[5:])
+    index = np.ndarray(index_bytes, dtype=np.uint8, buffer=shm.buf, offset=header.nbytes)
+    values = np.ndarray((3, bins), dtype=np.float64, buffer=shm.buf, offset=header.nbytes + index_bytes)
+    return header, index, values
+
+
+# Serves /data on listen from a DataPublisher's shared memory. Every worker binds the same
+# addresses with SO_REUSEPORT and the kernel shares connections out between them.
+def api_process_main(shm_name, listen):
+    # The server handles Ctrl+C and stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Every segment followed so far, and their views. Old ones stay open as other threads may
+    # still be reading them
+    segments = [shared_memory.SharedMemory(name=shm_name)]
+    views = [api_shm_views(segments[0])]
+    follow_lock = threading.Lock()
+    api_app = Flask(__name__)
+    # (ETag, body) of the last full response, which most clients ask for
+    cached = [None, None]
+    # Long polls waiting in this process
+    long_polls = [0]
+    long_polls_lock = threading.Lock()
+
+    # Returns (header, index, values) of the segment being published to, following replacements
+    def current():
+        if views[-1][0][4] != 1:
+            return views[-1]
+
+        with follow_lock:
+            header, index, values = views[-1]
+            while header[4] == 1:
+                if header[0] % 2 == 1:
+                    time.sleep(0.001)
+                    continue
+                segments.append(shared_memory.SharedMemory(name=index[: int(header[1])].tobytes().decode()))
+                views.append(api_shm_views(segments[-1]))
+                header, index, values = views[-1]
+            return views[-1]
+
+    # Returns (ETag, revision, body) for /data?since=since, with body None if the client is up to date
+    def read(since, etags):
+        while True:
+            header, index, values = current()
+            sequence = int(header[0])
+            # Being rewritten, or not published yet
+            if sequence % 2 == 1 or sequence == 0:
+                time.sleep(0.001)
+                continue
+
+            index_bytes, revision, config_version = (int(value) for value in header[1:4])
+            etag = f"{config_version}-{revision}"
+            body = None
+
+            if etag in etags:
+                # The client already has it
+                pass
+            elif since is None and cached[0] == etag:
+                body = cached[1]
+            else:
+                try:
+                    published = json.loads(index[:index_bytes].tobytes())
+                except ValueError:
+                    # Rewritten while it was being read, otherwise something is wrong
+                    if int(header[0]) != sequence:
+                        continue
+                    raise
+                full = since is None or since < published["full_revision"] or since > revision
+
+                body = {
+                    "revision": revision,
+                    "start_mhz": published["start_mhz"],
+                    "end_mhz": published["end_mhz"],
+                    "bandwidth_mhz": published["bandwidth_mhz"],
+                    "sdrs": [],
+                }
+                for sdr in published["sdrs"]:
+                    if not full and sdr["revision"] <= since:
+                        continue
+
+                    bins = slice(sdr["offset"], sdr["offset"] + sdr["bins"])
+                    measurement = {
+                        key: value for key, value in sdr.items() if key not in ("offset", "bins", "occupancy", "revision")
+                    }
+                    measurement["data"] = measurement_data(
+                        values[0, bins], values[1, bins], values[2, bins] if sdr["occupancy"] else None
+                    )
+                    body["sdrs"].append(measurement)
+
+                if since is not None:
+                    body["full"] = full
+                    body["removed"] = [] if full else [
+                        address for address, removed in published["removed"].items() if removed > since
+                    ]
+
+            # Rewritten while it was being read
+            if int(header[0]) == sequence:
+                if since is None and body is not None:
+                    cached[:] = etag, body
+                return etag, revision, body
+
+    def data_endpoint():
+        since = request.args.get("since", type=int)
+        wait_s = min(request.args.get("wait", 0, type=float), DATA_LONG_POLL_MAX_S)
+
+        # Long poll, hold the request until something changes, including the tasking
+        with long_polls_lock:
+            waiting = since is not None and wait_s > 0 and long_polls[0] < DATA_LONG_POLL_MAX_WAITERS
+            if waiting:
+                long_polls[0] += 1
+
+        if waiting:
+            config_version = int(current()[0][3])
+            deadline = time.monotonic() + wait_s
+            try:
+                while time.monotonic() < deadline:
+                    header = current()[0]
+                    if int(header[2]) != since or int(header[3]) != config_version:
+                        break
+                    time.sleep(API_LONG_POLL_CHECK_S)
+            finally:
+                with long_polls_lock:
+                    long_polls[0] -= 1
+
+        etag, revision, body = read(since, request.if_none_match.as_set())
+        response = api_response("", 304) if body is None else api_response(body)
+
+        # Let browsers keep the response and revalidate it with If-None-Match
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["Access-Control-Expose-Headers"] = "ETag"
+        return response
+
+    api_app.add_url_rule("/data", view_func=data_endpoint)
+
+    sockets = []
+    for address in listen.split():
+        host, port = address.rsplit(":", 1)
+        sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host.strip("[]"), int(port)))
+        sockets.append(sock)
+
+    serve(api_app, sockets=sockets, threads=SERVE_THREADS)
+
+
+# Has collect_loop look at the registry now rather than on its next timeout
+def wake_collect_loop():
+    if collect_wakeup is not None:
+        loop, wakeup = collect_wakeup
+        loop.call_soon_threadsafe(wakeup.set)
+
+
+def collect_thread_fn():
+    asyncio.run(collect_loop())
+
+
+# Seconds until a node should be polled again after a poll that took duration_s.
+# Must be called with registry.lock held.
+def next_poll_delay(node, err, duration_s, sweep_s):
+    if err:
+        if node["failures"] >= COLLECT_CIRCUIT_FAILURES:
+            return COLLECT_CIRCUIT_OPEN_S
+
+        interval_s = node["sweep_s"] if node["sweep_s"] is not None else COLLECT_MIN_INTERVAL_S
+        return min(interval_s * 2 ** node["failures"], COLLECT_BACKOFF_MAX_S)
+
+    # Nodes that don't report their sweep duration take about a sweep to answer
+    sample_s = sweep_s if sweep_s is not None else duration_s
+
+    if node["sweep_s"] is None:
+        node["sweep_s"] = sample_s
+    else:
+        node["sweep_s"] = 0.7 * node["sweep_s"] + 0.3 * sample_s
+
+    return min(max(node["sweep_s"], COLLECT_MIN_INTERVAL_S), COLLECT_MAX_INTERVAL_S)
+
+
+# Polls every node on its own timer. schedule is a heap of (due, address) and
+# scheduled maps each address to its pending due time, or None while it is being polled.
+# polling holds the task polling each address, so polls for an old tasking can be cancelled.
+async def collect_loop():
+    session = create_collect_session()
+    semaphore = asyncio.Semaphore(COLLECT_MAX_CONCURRENT)
+    wakeup = asyncio.Event()
+    global collect_wakeup
+    collect_wakeup = (asyncio.get_running_loop(), wakeup)
+    schedule = []
+    scheduled = {}
+    polling = {}
+    # Nodes whose next poll is their first since the tasking changed
+    preempt = set()
+    membership = None
+    tasking = None
+
+    # Polls the node and returns how long until it should be polled again, or None if it has gone
+    async def poll_node(address):
+        config = config_store.snapshot()
+
+        with registry.lock:
+            node = registry.get(address)
+            shard = node["shard"] if node is not None else (0, 1)
+            etag = node["etag"] if node is not None else None
+            aggregator = node["aggregator"] if node is not None else False
+            last_success = node["last_success"] if node is not None else None
+
+        start_mhz, end_mhz = shard_tasking(
+            config["start_mhz"], config["end_mhz"], config["bandwidth_mhz"], *shard
+        )
+        settings = {
+            "start_mhz": start_mhz,
+            "end_mhz": end_mhz,
+            "bandwidth_mhz": config["bandwidth_mhz"],
+        }
+        # Configs from before capture profiles leave the node to its defaults
+        if "profile" in config:
+            settings["profile"] = thaw(config["profile"])
+        if "measurement" in config:
+            settings["measurement"] = thaw(config["measurement"])
+        # Lets the node answer 304 when nothing moved by more than the deadband
+        if config.get("deadband_db", 0) > 0:
+            settings["deadband_db"] = config["deadband_db"]
+            settings["max_silence_s"] = config.get("max_silence_s", 3600)
+        # Nodes answer from a cache of recent sweeps. Only take a sweep finished since the last
+        # answer, so polls on the adaptive schedule get a new sweep rather than the one they just had
+        if last_success is not None and not aggregator:
+            settings["max_age_s"] = max(time.time() - last_success, 0)
+        # Has the node drop what it was sweeping for the old tasking rather than finish it first
+        if address in preempt and not aggregator:
+            settings["preempt"] = True
+        preempt.discard(address)
+
+        # A node has to sweep the whole range before it can answer a new tasking
+        timeout_s = REQUEST_TIMEOUT_S + plan_sweep(
+            start_mhz, end_mhz, config["bandwidth_mhz"], validate_profile(settings.get("profile"))
+        )["sweep_s"]
+
+        sdr = {"address": address, "start_mhz": start_mhz, "end_mhz": end_mhz}
+
+        async with semaphore:
+            started = time.monotonic()
+            lease = None
+            if collectors is not None:
+                err, sdr, result, lease = await collectors.collect(sdr, settings, timeout_s, etag, aggregator)
+            elif aggregator:
+                err, sdr, result = await collect_aggregate(session, sdr, settings, etag)
+            else:
+                err, sdr, result = await collect(session, sdr, settings, timeout_s, etag)
+            duration_s = time.monotonic() - started
+
+        node_request_seconds.observe(duration_s, node=address)
+        if err:
+            node_errors.inc(node=address)
+
+        cloudrf_noise_data = []
+
+        try:
+            if err:
+                log_msg(f"Error collection data from {address}: {result}", COLOR_RED)
+            elif aggregator:
+                stored = store_aggregate(sdr, result, cloudrf_noise_data)
+                if stored > 0:
+                    log_msg(f"Succesfully collected data for {stored} nodes from {address}")
+            elif store_result(sdr, result, cloudrf_noise_data):
+                log_msg(f"Succesfully collected data from {address}")
+        finally:
+            # store_result keeps only what it has copied out of the collector's shared memory
+            if collectors is not None:
+                collectors.release(lease)
+
+        if len(cloudrf_noise_data) > 0:
+            uploader.submit(cloudrf_noise_data)
+
+        with registry.lock:
+            node = registry.get(address)
+            if node is None:
+                return None
+
+            if err:
+                registry.record_error(address, result)
+                sweep_s = None
+            elif aggregator:
+                sweep_s = result["sweep_s"]
+            else:
+                sweep_s = result[4]
+            delay_s = next_poll_delay(node, err, duration_s, sweep_s)
+
+            if node["failures"] == COLLECT_CIRCUIT_FAILURES:
                 log_msg(
-                    f"Error posting measurements to {config['cloudrf_api']}: {e}", COLOR_RED
+                    f"{address} failed {COLLECT_CIRCUIT_FAILURES} times in a row, retrying every {COLLECT_CIRCUIT_OPEN_S}s",
+                    COLOR_YELLOW,
                 )
 
+        return delay_s
+
+    async def poll(address):
+        # Used if polling fails in a way nobody expected, so the node is never dropped
+        delay_s = COLLECT_MAX_INTERVAL_S
+
         try:
-            draw_output()
+            delay_s = await poll_node(address)
         except Exception as e:
-            log_msg(f"Failed to draw output {e}", COLOR_RED)
+            log_msg(f"Error polling {address}: {e}", COLOR_RED)
+        finally:
+            # Only reschedule if the node wasn't removed, or removed and re-added, meanwhile
+            if delay_s is not None and address in scheduled and scheduled[address] is None:
+                scheduled[address] = time.monotonic() + delay_s
+                heapq.heappush(schedule, (scheduled[address], address))
+                wakeup.set()
+
+    def poll_done(address, task):
+        if polling.get(address) is task:
+            del polling[address]
+
+    while True:
+        retasked = False
+
+        # Pick up nodes that have been added or removed
+        with registry.lock:
+            if tasking != registry.tasking:
+                retasked = tasking is not None
+                tasking = registry.tasking
+
+            if membership != registry.membership:
+                membership = registry.membership
+
+                for address in list(scheduled):
+                    if address not in registry:
+                        del scheduled[address]
+                        preempt.discard(address)
+                        node_request_seconds.remove(node=address)
+                        node_errors.remove(node=address)
+
+                for address, node in registry.nodes.items():
+                    # Nodes behind an aggregator come with it
+                    if node["via"] is None and address not in scheduled:
+                        scheduled[address] = time.monotonic() + random.uniform(0, COLLECT_JITTER_S)
+                        heapq.heappush(schedule, (scheduled[address], address))
+
+        # Sweep a new tasking straight away. Polling a node with it restarts its capture on the
+        # new range, so answers to polls for the old one would only be thrown away.
+        if retasked:
+            for task in polling.values():
+                task.cancel()
+
+            preempt.update(scheduled)
+            now = time.monotonic()
+            for address in scheduled:
+                scheduled[address] = now + random.uniform(0, COLLECT_RETASK_JITTER_S)
+                heapq.heappush(schedule, (scheduled[address], address))
+
+            log_msg(f"Tasking changed, polling {len(scheduled)} nodes", COLOR_GREEN)
 
-        time.sleep(DATA_COLLECTION_INTERVAL_S)
+        now = time.monotonic()
+
+        if len(schedule) > 0 and schedule[0][0] <= now:
+            due, address = heapq.heappop(schedule)
+
+            # Skip entries left behind by removed nodes
+            if scheduled.get(address) == due:
+                scheduled[address] = None
+                task = polling[address] = asyncio.create_task(poll(address))
+                task.add_done_callback(functools.partial(poll_done, address))
+
+            continue
+
+        wakeup.clear()
+        timeout_s = schedule[0][0] - now if len(schedule) > 0 else 1
+
+        try:
+            await asyncio.wait_for(wakeup.wait(), min(timeout_s, 1))
+        except asyncio.TimeoutError:
+            pass
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DORA server")
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="print logs instead of drawing the console, the default when not run from a terminal",
+    )
+    parser.add_argument(
+        "--no-metrics",
+        action="store_true",
+        help="don't collect the timings and counts served by /metrics",
+    )
+    parser.add_argument(
+        "--listen",
+        default="0.0.0.0:8080",
+        help="address:port to serve on, several can be given separated by spaces",
+    )
+    parser.add_argument(
+        "--collectors",
+        type=int,
+        default=0,
+        help="poll nodes from this many worker processes instead of the server process",
+    )
+    parser.add_argument(
+        "--api-workers",
+        type=int,
+        default=0,
+        help="also serve /data from this many worker processes on --api-listen",
+    )
+    parser.add_argument(
+        "--api-listen",
+        default="0.0.0.0:8081",
+        help="address:port the --api-workers serve /data on, several can be given separated by spaces",
+    )
+    args = parser.parse_args()
+
     if not REQUEST_VERIFY_SSL:
         urllib3.disable_warnings()
 
-    serve_thread = threading.Thread(target=serve_thread_fn, daemon=True)
+    if args.no_metrics:
+        metrics.enabled = False
+
+    config_store = ConfigStore(CONFIG_FILE)
+
+    with registry.lock:
+        registry.shard_radius_m = config_store.snapshot().get("shard_radius_m", 0)
+        registry.sync(config_store.snapshot().get("sdrs", []))
+
+    uploader = CloudRFUploader(UPLOAD_JOURNAL_FILE, UPLOAD_REJECTED_FILE)
+    uploader.start()
+
+    history = HistoryStore(HISTORY_FILE)
+    history.start()
+
+    if args.collectors > 0:
+        collectors = CollectorPool(args.collectors)
+        collectors.start()
+
+    if args.api_workers > 0:
+        publisher = DataPublisher()
+        publisher.start(args.api_workers, args.api_listen)
+
+    # Stop on SIGTERM the same way as Ctrl+C, so pending config writes and queued uploads are saved
+    def sigterm_handler(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, sigterm_handler)
+
+    serve_thread = threading.Thread(target=serve_thread_fn, args=(args.listen,), daemon=True)
     collect_thread = threading.Thread(target=collect_thread_fn, daemon=True)
 
     serve_thread.start()
     collect_thread.start()
 
-    curses.wrapper(curses_main)
+    try:
+        if args.headless or not sys.stdout.isatty():
+            headless_main()
+        else:
+            curses.wrapper(curses_main)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        uploader.close()
+        config_store.flush()
+        if collectors is not None:
+            collectors.close()
+        if publisher is not None:
+            publisher.close()